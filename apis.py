@@ -1,12 +1,17 @@
-from typing import Generator, Optional, Dict, Union, Iterable, Tuple, List, cast, Any, Set
+from typing import Generator, Optional, Dict, Union, Iterable, Tuple, List, cast, Any, Set, Type
 from flask import current_app as app, g
 import requests as req
 from abc import ABCMeta, abstractmethod
 import fhir
-import jmespath as path
+import pathcompiler as path
 import json
 import umls
-from gevent import spawn, iwait, Greenlet, pool
+import httpclient
+from cache import PersistentCache, open_cache
+from trialstore import open_store
+from gevent import spawn, iwait, killall, Greenlet
+from gevent.queue import Queue
+from fhirstream import BundleStream
 import logging
 
 class Api():
@@ -16,11 +21,11 @@ class Api():
     def __init__(self):
         self.base_url: str = app.config[self.url_config]
 
-    def _get_response(self, url: str, headers: Optional[Dict[str,str]] = None, params: Optional[Dict[str, Union[str, List[str]]]] = None) -> req.Response:
-        return req.get(url, headers=headers, params=params, verify=False)
+    def _get_response(self, url: str, headers: Optional[Dict[str,str]] = None, params: Optional[Dict[str, Union[str, List[str]]]] = None, stream: bool = False, hedge: bool = False) -> req.Response:
+        return httpclient.get(url, headers=headers, params=params, verify=False, stream=stream, hedge=hedge)
 
-    def _get(self, url: str, headers: Optional[Dict[str, str]] = None, params: Optional[Dict[str, Union[str, List[str]]]] = None) -> Dict[str,Any]:
-        res= self._get_response(url, headers=headers, params=params)
+    def _get(self, url: str, headers: Optional[Dict[str, str]] = None, params: Optional[Dict[str, Union[str, List[str]]]] = None, hedge: bool = False) -> Dict[str,Any]:
+        res= self._get_response(url, headers=headers, params=params, hedge=hedge)
         if res.status_code != 200:
             logging.warn(f"Invalid response. url = {url}, status code = {res.status_code}, response text={res.text}")
             return {"error": str(res.status_code)}
@@ -36,73 +41,117 @@ class UmlsApi(Api):
     }
 
     def __init__(self):
-        self.auth = umls.Authentication(app.config['UMLS_API_KEY'])
-        self.tgt = g.setdefault('tgt', self.auth.gettgt())
+        self.apikey: str = app.config['UMLS_API_KEY']
+        self.cache_path: str = app.config['UMLS_CACHE_PATH']
+        self.cache_ttl: float = app.config['UMLS_CACHE_TTL']
+        self.cache_negative_ttl: float = app.config['UMLS_CACHE_NEGATIVE_TTL']
         super().__init__()
 
-    def get_crosswalk(self, orig_code: str, codeset: str) -> Tuple[Optional[str], Optional[str]]:
-        tik = self.auth.getst(self.tgt)
-        #params = {"targetSource": "NCI", "ticket": tik}
-        params = {"apiKey": self.auth.apikey}
-        route = "/crosswalk/current/source/"
+    def _cache(self) -> PersistentCache:
+        return open_cache(self.cache_path, ttl=self.cache_ttl, negative_ttl=self.cache_negative_ttl)
+
+    @staticmethod
+    def _normalize_code(orig_code: str) -> str:
         if orig_code[-1] == '.':
             logging.warn(f"Original Code = {orig_code}")
             orig_code = orig_code[:-1]
             logging.warn(f"New code = {orig_code}")
+        return orig_code
+
+    def _fetch_crosswalk(self, orig_code: str, codeset: str) -> Tuple[bool, Optional[List[str]]]:
+        # Returns (cacheable, [code, description]); transient failures are not cacheable
+        #params = {"targetSource": "NCI", "ticket": tik}
+        params: Dict[str, Union[str, List[str]]] = {"apiKey": self.apikey}
+        route = "/crosswalk/current/source/"
         url = f"{self.base_url}{route}{codeset}/{orig_code}"
-        response = self._get_response(url, params=params)
+        # apiKey authentication makes the crosswalk safe to hedge; ticket-authenticated calls are single use
+        response = self._get_response(url, params=params, hedge=True)
+        if response.status_code == 404:
+            return True, None
         if response.status_code != 200:
-            return None, None
+            return False, None
         result = response.json()
         crosswalk = self.extraction_functions['crosswalk'].search(result)
-        return (crosswalk['code'], crosswalk['description'])
+        if crosswalk is None:
+            return True, None
+        return True, [crosswalk['code'], crosswalk['description']]
 
-    def get_code(self, description: str) -> List[Tuple[str, str]]:
-        tik = self.auth.getst(self.tgt)
-        params = {"string": description, "ticket": tik, "searchType": "words", "returnIdType": "sourceUi", "sabs": "NCI", "page_size": "1000"}
+    def get_crosswalk(self, orig_code: str, codeset: str) -> Tuple[Optional[str], Optional[str]]:
+        orig_code = self._normalize_code(orig_code)
+        key = f"{codeset}|{orig_code}"
+        hit, crosswalk = self._cache().get('crosswalk', key)
+        if not hit:
+            cacheable, crosswalk = self._fetch_crosswalk(orig_code, codeset)
+            if cacheable:
+                self._cache().put('crosswalk', key, crosswalk)
+        if crosswalk is None:
+            return None, None
+        return (crosswalk[0], crosswalk[1])
+
+    def _search(self, description: str, search_type: str) -> Optional[List[List[str]]]:
+        key = description.lower()
+        hit, results = self._cache().get(f"search-{search_type}", key)
+        if hit:
+            return results
+        tik = umls.tickets(self.apikey).service_ticket()
+        params = {"string": description, "ticket": tik, "searchType": search_type, "returnIdType": "sourceUi", "sabs": "NCI", "page_size": "1000"}
         route = "/search/current"
         url = f"{self.base_url}{route}"
         response = self._get_response(url, params=params)
         if response.status_code != 200:
-            return []
+            return None
         res = response.json()
-        results = []
-        for result in res["result"]["results"]:
-            if "rootSource" in result and result["rootSource"] == "NCI":
-                results.append((result["ui"], result["name"]))
+        results = [[result["ui"], result["name"]] for result in res["result"]["results"]
+                        if "rootSource" in result and result["rootSource"] == "NCI"]
+        self._cache().put(f"search-{search_type}", key, results)
         return results
 
+    def get_code(self, description: str) -> List[Tuple[str, str]]:
+        results = self._search(description, "words")
+        if results is None:
+            return []
+        return [(ui, name) for ui, name in results]
+
     def get_code_exact(self, description: str) -> Union[Tuple[str, str], Tuple[None, None]]:
-        tik = self.auth.getst(self.tgt)
-        params = {"string": description, "ticket": tik, "searchType": "exact", "returnIdType": "sourceUi", "sabs": "NCI", "page_size": "1000"}
-        route = "/search/current"
-        url = f"{self.base_url}{route}"
-        response = self._get_response(url, params=params)
-        if response.status_code != 200:
+        results = self._search(description, "exact")
+        if not results:
             return None, None
-        res = response.json()
-        for result in res["result"]["results"]:
-            if "rootSource" in result and result["rootSource"] == "NCI":
-                return result["ui"], result["name"]
-        return None, None
+        return results[0][0], results[0][1]
+
+    def _match(self, orig_code: str, crosswalk: Optional[Tuple[Optional[str], Optional[str]]]) -> Tuple[str, Optional[Dict[str, str]]]:
+        ncit_code, ncit_desc = crosswalk if crosswalk else (None, None)
+        if ncit_code and ncit_desc:
+            logging.info(f"Match for {orig_code} is {ncit_code}")
+            return orig_code, {'match': ncit_code, 'description': ncit_desc}
+        else:
+            logging.info(f"No match for {orig_code}")
+            return orig_code, None
 
     def get_matches(self, conditions_by_code: Dict[str, Dict[str, str]]) -> Iterable[Tuple[str, Optional[Dict[str, str]]]]:
-        matches: Dict[Greenlet, str] = {}
-        for orig_code, condition in conditions_by_code.items():
-            logging.info(f"Getting match for {condition['codeset']} code {orig_code} [{condition['description']}] ")
-            matches[spawn(self.get_crosswalk, orig_code, condition['codeset'])] = orig_code
+        # One result per code; codes that only differ by a trailing "." share a cache entry and a lookup
+        keys = {orig_code: f"{condition['codeset']}|{self._normalize_code(orig_code)}" for orig_code, condition in conditions_by_code.items()}
+        cached = self._cache().get_many('crosswalk', set(keys.values()))
+        logging.info(f"{len(cached)} of {len(keys)} crosswalks found in cache")
+        lookups: Dict[str, Greenlet] = {}
+        matches: Dict[Greenlet, List[str]] = {}
+        for orig_code, key in keys.items():
+            if key in cached:
+                crosswalk = cached[key]
+                yield self._match(orig_code, (crosswalk[0], crosswalk[1]) if crosswalk else None)
+                continue
+            lookup = lookups.get(key)
+            if lookup is None:
+                condition = conditions_by_code[orig_code]
+                logging.info(f"Getting match for {condition['codeset']} code {orig_code} [{condition['description']}] ")
+                lookup = lookups[key] = spawn(self.get_crosswalk, orig_code, condition['codeset'])
+                matches[lookup] = []
+            matches[lookup].append(orig_code)
         for match in iwait(matches):
-            orig_code = matches[match]
-            ncit_code, ncit_desc = cast(Tuple[Optional[str], Optional[str]], match.value)
-            if ncit_code and ncit_desc:
-                logging.info(f"Match for {orig_code} is {ncit_code}")
-                yield orig_code, {'match': ncit_code, 'description': ncit_desc}
-            else:
-                logging.info(f"No match for {orig_code}")
-                yield orig_code, None
+            for orig_code in matches[match]:
+                yield self._match(orig_code, cast(Tuple[Optional[str], Optional[str]], match.value))
 
     def perform_query(self, route, body):
-        tik = self.auth.getst(self.tgt)
+        tik = umls.tickets(self.apikey).service_ticket()
         body['ticket'] = tik
         url = f"{self.base_url}{route}"
         response = self._get_response(url, params=body)
@@ -123,6 +172,7 @@ class NciApi(Api):
         self.age: int
         self.gender: str
         self.ncit_codes: Set[str]
+        self.local_store: Optional[str] = app.config.get('TRIALS_LOCAL_STORE')
         super().__init__()
 
     def _get_trials_page(self, start_from: int) -> Dict[str,Any]:
@@ -134,7 +184,7 @@ class NciApi(Api):
         params["eligibility.structured.max_age_in_years_gte"] = str(self.age)
         params["eligibility.structured.min_age_in_years_lte"] = str(self.age)
         params['current_trial_status'] = 'Active'
-        return self._get(url, params=params)
+        return self._get(url, params=params, hedge=True)
 
     def _add_disease_list(self, trial: Dict[str, Any]) -> None:
         diseases =  self.ncit_codes & set(self._extract_functions['diseases'].search(trial))
@@ -146,6 +196,12 @@ class NciApi(Api):
         self.age = age
         self.gender = gender
         self.ncit_codes = ncit_codes
+        if self.local_store:
+            logging.info(f"Trial query against local store {self.local_store}")
+            for trial in open_store(self.local_store).find(age, gender, ncit_codes):
+                self._add_disease_list(trial)
+                yield trial
+            return
         logging.info("Trial query starting at 1")
         first_page = self._get_trials_page(1)
         logging.info("Received trials starting at 1")
@@ -177,26 +233,107 @@ class PatientApi(Api):
         headers = {"Authorization": f"Bearer {self.token}"}
         return self._get(url, headers, params)
 
+    def stream(self, url: str, params: Optional[Dict[str,Union[str, List[str]]]] = None) -> BundleStream:
+        headers = {"Authorization": f"Bearer {self.token}"}
+        res = self._get_response(url, headers=headers, params=params, stream=True)
+        if res.status_code != 200:
+            logging.warn(f"Invalid response. url = {url}, status code = {res.status_code}, response text={res.text}")
+            res.close()
+            failed = BundleStream([])
+            failed.header['error'] = str(res.status_code)
+            return failed
+        return BundleStream(_iter_body(res), res.encoding or 'utf-8')
+
+# Statuses with which a FHIR server refuses the search parameters themselves, rather than failing to answer
+SEARCH_REJECTED_STATUSES = {'400', '422'}
+
+def _search_rejected(bundle: Dict[str, Any]) -> bool:
+    return bundle.get('error') in SEARCH_REJECTED_STATUSES or bundle.get('resourceType') == 'OperationOutcome'
+
+def _iter_body(res: req.Response, chunk_size: int = 64*1024) -> Iterable[bytes]:
+    try:
+        yield from res.iter_content(chunk_size)
+    finally:
+        res.close()
+
 class FhirApi(PatientApi):
 
-    extraction_functions: Dict[str, path.parser.ParsedResult] = {
+    extraction_functions: Dict[str, path.CompiledPath] = {
         'resources': path.compile('entry[*].resource'),
         'next': path.compile("link[?relation=='next'].url | [0]")
     }
 
+    stream_queue_size = 1000
+
+    # Index into FHIRResource.projections() of the first projection each (base url, endpoint) accepted
+    projection_levels: Dict[Tuple[str, str], int] = {}
+
+    def __init__(self, id: str, token: str):
+        super().__init__(id, token)
+        self.streaming: bool = app.config.get('FHIR_STREAMING', False)
+        self.last_total: Optional[int] = None
+        self.last_rejected: bool = False
+
     def page_parameter(self, page:int) -> str:
         pass
 
+    def _stream_page(self, url_page: str, params, resources: Queue) -> None:
+        # Puts the page's resources, then the exception if the page failed, then None
+        try:
+            logging.info(f"Streaming resource at {url_page}")
+            page = self.stream(url_page, params)
+            for resource in page:
+                resources.put(resource)
+            if 'error' in page.header:
+                raise req.HTTPError(f"{url_page} returned status {page.header['error']}")
+        except Exception as e:
+            logging.warning(f"Streaming {url_page} failed: {e}")
+            resources.put(e)
+        finally:
+            resources.put(None)
+
+    def _get_fhir_bundle_streamed(self, url: str, endpoint: str, params, count: int) -> Iterable[Dict[str, Union[str, list, dict]]]:
+        logging.info(f"Streaming resource at {url}")
+        first_page = self.stream(url, params)
+        for resource in first_page:
+            yield resource
+        self.last_total = first_page.header.get('total')
+        self.last_rejected = _search_rejected(first_page.header)
+        total = first_page.header.get('total', 0)
+        logging.info(f"Total {total}, received {url}")
+        if total>count:
+            final_page = ((total-1) // count) + 1
+            resources: Queue = Queue(maxsize=self.stream_queue_size)
+            greenlets = [spawn(self._stream_page, f"{url}{self.page_parameter(page_num)}", params, resources)
+                            for page_num in range(2, final_page+1)]
+            try:
+                remaining = len(greenlets)
+                while remaining:
+                    resource = resources.get()
+                    if resource is None:
+                        remaining -= 1
+                    elif isinstance(resource, Exception):
+                        # A page that failed part way would otherwise leave the resource list silently short
+                        raise resource
+                    else:
+                        yield resource
+            finally:
+                killall(greenlets, block=False)
+
     def get_fhir_bundle(self, endpoint: str, params=None, count=100) -> Iterable[Dict[str, Union[str, list, dict]]]:
         url: str = f"{self.base_url}{endpoint}?patient={self.id}&_count={count}"
+        if self.streaming:
+            yield from self._get_fhir_bundle_streamed(url, endpoint, params, count)
+            return
         logging.info(f"Getting resource at {url}")
         bundle = self.get(url, params)
+        self.last_total = bundle.get('total')
+        self.last_rejected = _search_rejected(bundle)
         total = bundle.get('total', 0)
         logging.info(f"Total {total}, received {url}")
-        for resource in self.extraction_functions['resources'].search(bundle):
+        for resource in self.extraction_functions['resources'].search(bundle) or []:
             yield resource
         if total>count:
-            gpool = pool.Pool(40)
             next_url = self.extraction_functions['next'].search(bundle)
             logging.info(f"Next url would be {next_url}")
             final_page = ((total-1) // count) + 1
@@ -205,8 +342,7 @@ class FhirApi(PatientApi):
                 page_param = self.page_parameter(page_num)
                 url_page = f"{url}{page_param}"
                 logging.info(f"Getting resource at {url_page}")
-                gpool.wait_available()
-                pages[gpool.spawn(self.get, url_page, params)] = url_page
+                pages[spawn(self.get, url_page, params)] = url_page
             if len(pages) == 0:
                 logging.warn("Unexpected issue, pages empty")
             else:
@@ -228,6 +364,23 @@ class FhirApi(PatientApi):
         #         yield resource
         #     url = self.extraction_functions['next'].search(bundle)
 
+    def get_resources(self, endpoint: str, resource_class: Type[fhir.FHIRResource], count=100) -> Iterable[Dict[str, Union[str, list, dict]]]:
+        key = (self.base_url, endpoint)
+        projections = resource_class.projections()
+        level = self.projection_levels.get(key, 0)
+        while True:
+            received = False
+            for resource in self.get_fhir_bundle(endpoint, projections[level] or None, count):
+                received = True
+                yield resource
+            if not self.last_rejected or level == len(projections) - 1:
+                # Only a level the server answered is remembered; outages and 5xx say nothing about the parameters
+                if received or self.last_total is not None:
+                    self.projection_levels[key] = level
+                return
+            level += 1
+            logging.warn(f"{endpoint} search rejected at {self.base_url}, retrying with parameters {projections[level]}")
+
     def get_demographics(self) -> fhir.Demographics:
         url = f"{self.base_url}Patient/{self.id}"
         return fhir.Demographics(self.get(url))
@@ -237,16 +390,16 @@ class VaApi(FhirApi):
     url_config = "VA_API_HEALTH_BASE_URL"
 
     def get_observations(self) -> Iterable[fhir.Observation]:
-        for resource in self.get_fhir_bundle("Observation"):
+        for resource in self.get_resources("Observation", fhir.Observation):
             yield fhir.Observation(resource)
 
     def get_conditions(self) -> Iterable[fhir.Condition]:
-        for resource in self.get_fhir_bundle("Condition"):
+        for resource in self.get_resources("Condition", fhir.Condition):
             yield fhir.Condition(resource)
     
     def get_medication_orders(self) -> Iterable[fhir.MedicationRequest]:
         self.base_url = app.config["VA_API_HEALTH_BASE_R4_URL"]
-        for resource in self.get_fhir_bundle("MedicationRequest"):
+        for resource in self.get_resources("MedicationRequest", fhir.MedicationRequest):
             yield fhir.MedicationRequest(resource)
         self.base_url = app.config[self.url_config]
 
@@ -258,7 +411,7 @@ class CmsApi(FhirApi):
     url_config = "CMS_API_BASE_URL"
 
     def get_explanations_of_benefit(self) -> Iterable[fhir.ExplanationOfBenefit]:
-        for resource in self.get_fhir_bundle('ExplanationOfBenefit', count=50):
+        for resource in self.get_resources('ExplanationOfBenefit', fhir.ExplanationOfBenefit, count=50):
             yield fhir.ExplanationOfBenefit(resource)
 
     def page_parameter(self, page:int) -> str:
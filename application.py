@@ -15,7 +15,7 @@ import filter
 import json
 from datetime import datetime
 from flask_socketio import SocketIO, join_room
-from flask import Flask, session, redirect, render_template, request, flash, make_response
+from flask import Flask, session, redirect, render_template, request, flash, make_response, jsonify
 from flask_session import Session
 from flask_talisman import Talisman
 from authlib.integrations.flask_client import OAuth
@@ -28,6 +28,7 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from labtests import labs
 from typing import Dict
 from apis import UmlsApi
+import httpclient
 
 args: dict = {}
 if __name__ == "__main__":
@@ -46,6 +47,7 @@ def read_config(environment: str):
 env = 'local' if args.get('local', app.env) == 'development' else ('test_aws' if app.env == 'test' else 'aws')
 read_config(env)
 read_config('default')
+httpclient.configure(app.config)
 
 log_level = args.get("log", app.config["CTS_LOGLEVEL"]).upper()
 
@@ -126,13 +128,34 @@ def getInfo():
         logging.debug(combined.va_patient().codes_ncit)
     return redirect("/")
 
+def nearby_trials(combined_patient):
+    # Trials with a site within the `within` query parameter (miles), or the `nearest` count of trials, with their
+    # nearest site; None when neither is given or the patient's location is unknown
+    miles = request.args.get('within', type=float)
+    count = request.args.get('nearest', type=int)
+    if miles is None and count is None:
+        return None
+    return combined_patient.nearby_trials(miles, count)
+
 @app.route('/trials')
 def show_all_trials():
     if not session.get("combined_patient", None):
         return welcome()
     lab_names = [filter.value_dict[lab]['display_name'] for lab in filter.value_dict.keys()]
     unit_names  = [filter.value_dict[lab]['default_unit_name'] for lab in filter.value_dict.keys()]
-    return render_template('welcome.html', form=FilterForm(), trials_selection="current", labs=labs, lab_names=lab_names, unit_names=unit_names)
+    combined_patient = session['combined_patient']
+    nearby = nearby_trials(combined_patient)
+    trials_by_ncit = combined_patient.trials_by_ncit
+    num_trials = combined_patient.numTrials
+    if nearby is not None:
+        # Only the trials near the patient, nearest first, under the conditions that still have any
+        trials_by_ncit = [{'ncit': code['ncit'], 'trials': sorted((trial for trial in code['trials'] if trial.id in nearby),
+                                                                  key=lambda trial: nearby[trial.id][0])}
+                          for code in trials_by_ncit]
+        trials_by_ncit = [code for code in trials_by_ncit if code['trials']]
+        num_trials = len({trial.id for code in trials_by_ncit for trial in code['trials']})
+    return render_template('welcome.html', form=FilterForm(), trials_selection="current", labs=labs, lab_names=lab_names, unit_names=unit_names,
+                           nearby=nearby, trials_by_ncit=trials_by_ncit, num_trials=num_trials, num_conditions=len(trials_by_ncit))
 
 @app.route('/excluded')
 def show_excluded():
@@ -195,10 +218,15 @@ def download_trails():
     si = io.StringIO()
     cw = csv.writer(si)
 
-    data = []
-    for trial_by_ncit in combined_patient.trials_by_ncit:
-        for trial in trial_by_ncit.get("trials", []):
-            data.append([getattr(trial, attribute) for attribute in header])
+    trials = [trial for trial_by_ncit in combined_patient.trials_by_ncit for trial in trial_by_ncit.get("trials", [])]
+    nearby = nearby_trials(combined_patient)
+    if nearby is not None:
+        trials = sorted((trial for trial in trials if trial.id in nearby), key=lambda trial: nearby[trial.id][0])
+    data = [[getattr(trial, attribute) for attribute in header] for trial in trials]
+    if nearby is not None:
+        header.append('distance')
+        for row, trial in zip(data, trials):
+            row.append(round(nearby[trial.id][0], 1))
 
     cw.writerow(header)
     cw.writerows(data)
@@ -216,11 +244,21 @@ class FilterForm(FlaskForm):
 
 @app.route('/add_lab_result', methods=['POST'])
 def add_lab_result():
-    body = dict(request.form)
     combined_patient = session['combined_patient']
     # TODO: ACCOUNT FOR UNITS
-    test_name = filter.reverse_value_dict[body['labType']]
-    combined_patient.latest_results[test_name] = body['labValue']
+    lab = filter.value_dict[filter.reverse_value_dict[request.form['labType']]]
+    try:
+        value = float(request.form.get('labValue', ''))
+    except ValueError:
+        flash(f"{lab['display_name']} value must be a number")
+        return redirect('/trials')
+    # Keyed by variable_name, the patient data key the eligibility matrix and the lab table read
+    variable = lab['variable_name']
+    result = hack.TestResult(variable, datetime.now(), value, request.form.get('unitValue') or lab['default_unit_name'])
+    if combined_patient.eligibility is None:
+        combined_patient.latest_results[variable] = result
+    else:
+        store_filter_results(combined_patient, *combined_patient.add_lab_result(variable, result))
     return redirect('/trials')
 
 @app.route('/search_condition', methods=['POST'])
@@ -259,6 +297,16 @@ def umls_query():
             body[arg] = args[arg]
     return UmlsApi().perform_query(route, body)
 
+def store_filter_results(combined_patient, filter_trails_by_inclusion_criteria, excluded_trails_by_inclusion_criteria):
+    combined_patient.trials_by_ncit = filter_trails_by_inclusion_criteria
+    combined_patient.numTrials = sum([len(x['trials']) for x in filter_trails_by_inclusion_criteria])
+    combined_patient.num_conditions_with_trials = len(filter_trails_by_inclusion_criteria)
+
+    session['excluded'] = excluded_trails_by_inclusion_criteria
+    combined_patient.filtered = True
+    session['excluded_num_trials'] = sum([len(x['trials']) for x in excluded_trails_by_inclusion_criteria])
+    session['excluded_num_conditions_with_trials'] = len(excluded_trails_by_inclusion_criteria)
+
 @app.route('/filter_by_lab_results', methods=['POST'])
 def filter_by_lab_results():
     """
@@ -275,19 +323,33 @@ def filter_by_lab_results():
 
     socketio.emit(event_name, {"data": 65}, room=session.sid)
 
-    session['combined_patient'].trials_by_ncit = filter_trails_by_inclusion_criteria
-    session['combined_patient'].numTrials = sum([len(x['trials']) for x in filter_trails_by_inclusion_criteria])
-    session['combined_patient'].num_conditions_with_trials = len(filter_trails_by_inclusion_criteria)
-
-    session['excluded'] = excluded_trails_by_inclusion_criteria
-    session['combined_patient'].filtered = True
-    session['excluded_num_trials'] = sum([len(x['trials']) for x in excluded_trails_by_inclusion_criteria])
-    session['excluded_num_conditions_with_trials'] = len(excluded_trails_by_inclusion_criteria)
+    store_filter_results(combined_patient, filter_trails_by_inclusion_criteria, excluded_trails_by_inclusion_criteria)
     socketio.emit(event_name, {"data": 95}, room=session.sid)
     socketio.emit('disconnect', {"data": 100}, room=session.sid)
     return redirect('/')
 
 
+@app.route('/what_if_lab_value')
+def what_if_lab_value():
+    """
+    JSON view of the trials that become eligible or ineligible as one lab value moves through a range.
+    Query parameters: lab (a lab's display name or variable key), low and high (optional range ends).
+    Answers 409 until the trials have been filtered by lab values.
+    """
+    if not session.get("combined_patient", None):
+        return make_response(jsonify({"error": "No patient loaded"}), 400)
+    lab = request.args.get('lab', '')
+    key = filter.reverse_value_dict.get(lab, lab)
+    if key not in filter.value_dict:
+        return make_response(jsonify({"error": f"Unknown lab {lab}"}), 404)
+    combined_patient = session['combined_patient']
+    result = combined_patient.what_if(filter.value_dict[key]['variable_name'],
+                                      request.args.get('low', type=float), request.args.get('high', type=float))
+    if result is None:
+        return make_response(jsonify({"error": "Filter the trials by lab values first"}), 409)
+    result['lab'] = filter.value_dict[key]['display_name']
+    return jsonify(result)
+
 class InfectedPatientsForm(FlaskForm):
     trial_nci_id = StringField('NCI Trial ID ', [validators.Length(max=25)])
 
@@ -0,0 +1,133 @@
+from typing import Any, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+from collections import OrderedDict
+import sqlite3 as sql
+import threading
+import json
+import time
+import os
+import logging
+
+T = TypeVar('T')
+
+class LruCache(Generic[T]):
+    """Bounded in-memory LRU, safe to share between threads and greenlets."""
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, T]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[T]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: T) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class PersistentCache:
+    """SQLite-backed key/value cache with TTL, LRU eviction and an in-memory LRU front tier.
+
+    Keys are (namespace, key) pairs and values are anything JSON serialisable. A stored value of None is a
+    negative entry ("upstream had no answer"); `get_many` reports it as a hit so callers can skip the network.
+    """
+
+    def __init__(self, path: str, ttl: float, negative_ttl: float, max_entries: int = 200000, memory_entries: int = 20000):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory: 'OrderedDict[Tuple[str, str], Tuple[Any, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sql.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, expires REAL, accessed REAL, PRIMARY KEY (namespace, key))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    def _remember(self, full_key: Tuple[str, str], value: Any, expires: float) -> None:
+        self._memory[full_key] = (value, expires)
+        self._memory.move_to_end(full_key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, namespace: str, keys: Iterable[str]) -> Dict[str, Any]:
+        now = time.time()
+        found: Dict[str, Any] = {}
+        missing: List[str] = []
+        requested = 0
+        with self._lock:
+            for key in keys:
+                requested += 1
+                entry = self._memory.get((namespace, key))
+                if entry is not None and entry[1] > now:
+                    self._memory.move_to_end((namespace, key))
+                    found[key] = entry[0]
+                else:
+                    missing.append(key)
+            if missing:
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start+500]
+                    marks = ",".join("?" * len(chunk))
+                    rows = self.conn.execute(f"SELECT key, value, expires FROM entries WHERE namespace=? AND expires>? AND key IN ({marks})",
+                                             [namespace, now, *chunk]).fetchall()
+                    for key, value, expires in rows:
+                        decoded = json.loads(value)
+                        found[key] = decoded
+                        self._remember((namespace, key), decoded, expires)
+                    if rows:
+                        self.conn.executemany("UPDATE entries SET accessed=? WHERE namespace=? AND key=?",
+                                              [(now, namespace, key) for key, _, _ in rows])
+            self.hits += len(found)
+            self.misses += requested - len(found)
+        return found
+
+    def get(self, namespace: str, key: str) -> Tuple[bool, Any]:
+        found = self.get_many(namespace, [key])
+        return (key in found, found.get(key))
+
+    def put_many(self, namespace: str, items: Dict[str, Any]) -> None:
+        now = time.time()
+        rows = []
+        with self._lock:
+            for key, value in items.items():
+                expires = now + (self.negative_ttl if value is None else self.ttl)
+                self._remember((namespace, key), value, expires)
+                rows.append((namespace, key, json.dumps(value), expires, now))
+            self.conn.executemany("INSERT OR REPLACE INTO entries (namespace, key, value, expires, accessed) VALUES (?, ?, ?, ?, ?)", rows)
+            self._writes += len(rows)
+            if self._writes >= 1000:
+                self._writes = 0
+                self._evict(now)
+
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        self.put_many(namespace, {key: value})
+
+    def _evict(self, now: float) -> None:
+        self.conn.execute("DELETE FROM entries WHERE expires<=?", (now,))
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if count > self.max_entries:
+            logging.info(f"Evicting {count - self.max_entries} entries from cache {self.path}")
+            self.conn.execute("DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY accessed LIMIT ?)",
+                              (count - self.max_entries,))
+
+_caches: Dict[str, PersistentCache] = {}
+
+def open_cache(path: str, **kwargs) -> PersistentCache:
+    cache = _caches.get(path)
+    if cache is None:
+        cache = _caches.setdefault(path, PersistentCache(path, **kwargs))
+    return cache
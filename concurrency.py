@@ -0,0 +1,156 @@
+from typing import Any, Deque, Dict, Optional, Tuple
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from flask import current_app as app, has_app_context
+from gevent import GreenletExit
+from gevent.event import Event
+import threading
+import time
+import logging
+
+DEFAULT_LIMITS: Tuple[int, int, int] = (8, 1, 10)
+DEFAULT_LATENCY_TARGET = 2.0
+
+class HostLimiter:
+    """AIMD concurrency limit for one upstream host.
+
+    Successful responses under the latency target grow the limit by roughly one slot per limit's worth of
+    responses; 429s, 5xx, errors and slow responses halve it, at most once per `backoff_interval`.
+    """
+
+    backoff_interval = 1.0
+
+    def __init__(self, host: str, initial: int, minimum: int, maximum: int, latency_target: float):
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.active = 0
+        self.latency = 0.0
+        self.completed = 0
+        self.throttled = 0
+        self._waiters: Deque[Event] = deque()
+        self._last_decrease = 0.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def acquire(self) -> None:
+        if self.active < int(self.limit) and not self._waiters:
+            self.active += 1
+            return
+        waiter = Event()
+        self._waiters.append(waiter)
+        try:
+            waiter.wait()
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.is_set():
+                self.active -= 1
+                self._wake()
+            raise
+
+    def _wake(self) -> None:
+        while self._waiters and self.active < int(self.limit):
+            self.active += 1
+            self._waiters.popleft().set()
+
+    def release(self, elapsed: float, status: Optional[int], cancelled: bool = False) -> None:
+        self.active -= 1
+        if cancelled:
+            # Abandoned by the caller (e.g. a losing hedge); says nothing about upstream health
+            self._wake()
+            return
+        self.completed += 1
+        self.latency = elapsed if self.completed == 1 else 0.8 * self.latency + 0.2 * elapsed
+        if status is None or status == 429 or status >= 500 or elapsed > 2 * self.latency_target:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.backoff_interval:
+                self._last_decrease = now
+                self.limit = max(float(self.minimum), self.limit / 2)
+                logging.info(f"Concurrency for {self.host} reduced to {int(self.limit)} (status={status}, latency={elapsed:.2f}s)")
+        elif elapsed <= self.latency_target:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+        self._wake()
+
+    def stats(self) -> Dict[str, float]:
+        return {'limit': int(self.limit), 'active': self.active, 'queued': self.queued,
+                'latency': round(self.latency, 3), 'completed': self.completed, 'throttled': self.throttled}
+
+class ConcurrencyController:
+    """Process-wide owner of the per-host concurrency budgets used by every outgoing request."""
+
+    def __init__(self):
+        self._limiters: Dict[str, HostLimiter] = {}
+        self._lock = threading.Lock()
+        self._settings: Optional[Dict[str, Any]] = None
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        self._settings = config
+
+    def _config(self, key: str, default: Any) -> Any:
+        if self._settings is not None:
+            return self._settings.get(key, default)
+        return app.config.get(key, default) if has_app_context() else default
+
+    def limiter_for(self, url: str) -> HostLimiter:
+        host = urlsplit(url).netloc
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(host)
+                if limiter is None:
+                    limits: Dict[str, Tuple[int, int, int]] = self._config('CONCURRENCY_LIMITS', {})
+                    target: float = self._config('CONCURRENCY_LATENCY_TARGET', DEFAULT_LATENCY_TARGET)
+                    initial, minimum, maximum = limits.get(host, DEFAULT_LIMITS)
+                    limiter = HostLimiter(host, initial, minimum, maximum, target)
+                    self._limiters[host] = limiter
+        return limiter
+
+    @contextmanager
+    def slot(self, url: str):
+        # A block that calls outcome.hold() keeps the slot after it exits, until outcome.release()
+        limiter = self.limiter_for(url)
+        limiter.acquire()
+        outcome = _Outcome(limiter)
+        try:
+            yield outcome
+        except GreenletExit:
+            outcome.cancelled = True
+            raise
+        finally:
+            outcome.elapsed = time.monotonic() - outcome.start
+            if not outcome.held:
+                outcome.release()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {host: limiter.stats() for host, limiter in list(self._limiters.items())}
+
+class _Outcome:
+    def __init__(self, limiter: HostLimiter):
+        self.limiter = limiter
+        self.start = time.monotonic()
+        self.elapsed = 0.0
+        self.status: Optional[int] = None
+        self.cancelled = False
+        self.held = False
+        self.released = False
+
+    def hold(self) -> None:
+        self.held = True
+
+    def release(self) -> None:
+        # Latency is measured to the end of the block, not to whenever a held slot is let go
+        if not self.released:
+            self.released = True
+            self.limiter.release(self.elapsed, self.status, self.cancelled)
+
+controller = ConcurrencyController()
+
+def stats() -> Dict[str, Dict[str, float]]:
+    return controller.stats()
@@ -0,0 +1,141 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from cache import LruCache
+import logging
+
+class Constraint:
+    """A parsed criterion on one patient variable; always satisfied unless a subclass says otherwise.
+
+    An exclusion criterion is satisfied when the patient's value does *not* match it. `str()` gives the explanation
+    shown next to a filtered trial, built only when rendered.
+    """
+
+    __slots__ = ('display_name', 'exclusion')
+
+    def __init__(self, display_name: str, exclusion: bool = False):
+        self.display_name = display_name
+        self.exclusion = exclusion
+
+    def test(self, value: float) -> bool:
+        return True
+
+    def __str__(self) -> str:
+        return self.display_name + ": "
+
+class IntervalConstraint(Constraint):
+
+    __slots__ = ('lower', 'lower_incl', 'upper', 'upper_incl')
+
+    def __init__(self, display_name: str, lower: Optional[float], lower_incl: bool, upper: Optional[float], upper_incl: bool,
+                 exclusion: bool = False):
+        super().__init__(display_name, exclusion)
+        self.lower = lower
+        self.lower_incl = lower_incl
+        self.upper = upper
+        self.upper_incl = upper_incl
+
+    def test(self, value: float) -> bool:
+        inside = True
+        if self.lower is not None and (value < self.lower if self.lower_incl else value <= self.lower):
+            inside = False
+        elif self.upper is not None and (value > self.upper if self.upper_incl else value >= self.upper):
+            inside = False
+        return inside != self.exclusion
+
+    def __str__(self) -> str:
+        text = self.display_name + ": "
+        if self.exclusion:
+            bounds = []
+            if self.lower is not None:
+                bounds.append("greater than " + str(self.lower))
+            if self.upper is not None:
+                bounds.append("less than " + str(self.upper))
+            return text + "Excluded if " + " and ".join(bounds) + ". " if bounds else text
+        if self.lower is not None:
+            text += "Must be greater than " + str(self.lower) + ". "
+        if self.upper is not None:
+            text += "Must be less than " + str(self.upper) + ". "
+        return text
+
+class SetConstraint(Constraint):
+
+    __slots__ = ('values', 'allowed')
+
+    def __init__(self, display_name: str, values: Tuple[float, ...], exclusion: bool = False):
+        super().__init__(display_name, exclusion)
+        self.values = values
+        self.allowed = frozenset(values)
+
+    def test(self, value: float) -> bool:
+        return (value in self.allowed) != self.exclusion
+
+    def __str__(self) -> str:
+        return self.display_name + ": " + ("Must not be one of: " if self.exclusion else "Must be one of: ") + \
+            ", ".join(str(value) for value in self.values)
+
+def _number(text: Any) -> float:
+    return float(str(text).replace(' ', ''))
+
+def _bound(relation: Dict[str, Any], side: str) -> Tuple[Optional[float], bool]:
+    bound = relation.get(side)
+    if bound is None:
+        return None, False
+    return _number(bound['value']), bool(bound['incl'])
+
+def patient_value(value: Any) -> Optional[float]:
+    # Patient data holds TestResult objects for fetched labs and form strings for entered ones
+    value = getattr(value, 'value', value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class CompiledCriteria:
+    """A trial's constraints grouped by the patient variable they test."""
+
+    __slots__ = ('by_variable',)
+
+    def __init__(self, by_variable: Dict[str, List[Constraint]]):
+        self.by_variable = by_variable
+
+    def evaluate(self, patient_data: Dict[str, Any]) -> Tuple[bool, List[Tuple[Constraint, bool]]]:
+        eligible = True
+        outcomes: List[Tuple[Constraint, bool]] = []
+        for variable, constraints in self.by_variable.items():
+            if variable not in patient_data:
+                continue
+            value = patient_value(patient_data[variable])
+            if value is None:
+                continue
+            for constraint in constraints:
+                satisfied = constraint.test(value)
+                eligible = eligible and satisfied
+                outcomes.append((constraint, satisfied))
+        return eligible, outcomes
+
+def compile_criteria(criteria: Iterable[Tuple[str, str, Dict[str, Any]]], variables: Dict[str, Dict[str, Any]]) -> CompiledCriteria:
+    # `variables` maps the parser's variable names to their patient data key and display name (filter.value_dict)
+    by_variable: Dict[str, List[Constraint]] = {}
+    for variable_type, eligibility_type, relation in criteria:
+        name = relation.get('name')
+        variable = variables.get(name) if name is not None else None
+        if variable is None:
+            continue
+        display_name = variable['display_name']
+        exclusion = eligibility_type == 'exclusion'
+        try:
+            if variable_type == 'numerical':
+                lower, lower_incl = _bound(relation, 'lower')
+                upper, upper_incl = _bound(relation, 'upper')
+                constraint: Constraint = IntervalConstraint(display_name, lower, lower_incl, upper, upper_incl, exclusion)
+            elif variable_type == 'ordinal':
+                constraint = SetConstraint(display_name, tuple(_number(value) for value in relation.get('value') or []), exclusion)
+            else:
+                constraint = Constraint(display_name)
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable relation {relation}: {e}")
+            continue
+        by_variable.setdefault(variable['variable_name'], []).append(constraint)
+    return CompiledCriteria(by_variable)
+
+# Compiled criteria by criteria key, shared by every filter pass
+compiled_cache: LruCache[CompiledCriteria] = LruCache()
@@ -0,0 +1,275 @@
+from typing import Any, Dict, Iterator, List, Optional, Pattern, Set, Tuple
+from collections import deque
+import csv
+import json
+import re
+import os
+import sys
+from criteriastore import Criterion
+
+PARSER_IO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_io")
+
+class _Automaton:
+    """Aho-Corasick automaton: a single pass over a text reports every occurrence of every added word."""
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[Tuple[int, Any]]] = [[]]
+
+    def add(self, word: str, value: Any) -> None:
+        state = 0
+        for char in word:
+            following = self.goto[state].get(char)
+            if following is None:
+                following = len(self.goto)
+                self.goto[state][char] = following
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            state = following
+        self.out[state].append((len(word), value))
+
+    def build(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(char, 0)
+                self.out[following] = self.out[following] + self.out[self.fail[following]]
+
+    def search(self, text: str) -> Iterator[Tuple[int, int, Any]]:
+        # (start, end, value) of every occurrence, overlapping ones included
+        state = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in out[state]:
+                yield position + 1 - length, position + 1, value
+
+# Comparator wording and the bound it sets: (side, inclusive)
+_COMPARATORS: Dict[str, Tuple[str, bool]] = {}
+for _phrases, _bound in [
+        (['>=', '=>', '≥', '≧', 'greater than or equal to', 'greater than or equal', 'more than or equal to', 'equal to or greater than',
+          'equal or greater than', 'at least', 'no less than', 'not less than', 'minimum of', 'minimum'], ('lower', True)),
+        (['>', 'greater than', 'more than', 'higher than', 'above', 'exceeding', 'in excess of', 'over'], ('lower', False)),
+        (['<=', '=<', '≤', '≦', 'less than or equal to', 'less than or equal', 'equal to or less than', 'equal or less than', 'at most',
+          'no more than', 'not more than', 'no greater than', 'not greater than', 'not exceeding', 'maximum of', 'maximum', 'up to'], ('upper', True)),
+        (['<', 'less than', 'lower than', 'below', 'under'], ('upper', False))]:
+    for _phrase in _phrases:
+        _COMPARATORS[_phrase] = _bound
+
+# "<number> or <word>" after the value
+_TRAILING = {'more': 'lower', 'greater': 'lower', 'higher': 'lower', 'above': 'lower', 'older': 'lower', 'over': 'lower',
+             'less': 'upper', 'lower': 'upper', 'below': 'upper', 'younger': 'upper', 'fewer': 'upper', 'under': 'upper'}
+
+_NUMBER = r"\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?"
+# What may stand between a variable and its value; any other word (e.g. "age at diagnosis", "weight loss") means the
+# value is about something else
+_GAP = r"(?:[\s:)]|\b(?:of|is|count)\b)*"
+
+def _alternation(words) -> str:
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+_COMPARATOR = _alternation(_COMPARATORS)
+_RANGE = rf"(?:between\s+)?(?P<low>{_NUMBER})\s*(?:-|–|to|and)\s*(?P<high>{_NUMBER})"
+_NUMERICAL = re.compile(
+    rf"{_GAP}(?:(?P<cmp>{_COMPARATOR})\s*(?P<value>{_NUMBER})"
+    rf"|{_RANGE}"
+    rf"|(?P<bare>{_NUMBER})\s*(?P<bare_unit>[^\d\s,;]*)\s*or\s+(?P<trailing>{'|'.join(_TRAILING)})\b)")
+_ORDINAL_LIST = re.compile(rf"{_GAP}(?P<list>\d+(?:\s*(?:,|/|or|and)\s*(?:or\s+|and\s+)?\d+)+)")
+_EXCLUSION = re.compile(r"exclusion criteria", re.IGNORECASE)
+_CONNECTOR = re.compile(r"[\s/(),\-]*(?:(?:and/or|and|or)[\s/(),\-]*)?$")
+
+def _number(text: str) -> str:
+    return text.replace(",", "")
+
+def _is_word(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+class CriteriaExtractor:
+    """In-process replacement for the cfg parser on the criteria it can read with confidence.
+
+    Every alias in variables.csv goes into one automaton, so each eligibility text is scanned once; after each
+    hit a comparator, a number or a range and an optional units.csv unit are read, directly after the alias. The
+    relations match the parser's output. `extract` returns None when any variable is mentioned without a value it
+    can read, or with a unit that does not fit the variable, and the trial is left to the parser.
+    """
+
+    def __init__(self, variables_path: str = os.path.join(PARSER_IO, "variables.csv"), units_path: str = os.path.join(PARSER_IO, "units.csv")):
+        self.variables: Dict[str, Dict[str, Any]] = {}
+        self.automaton = _Automaton()
+        with open(variables_path) as variables_csv:
+            for row in csv.DictReader(variables_csv):
+                if row['variable_type'] not in ('numerical', 'ordinal'):
+                    continue
+                self.variables[row['variable_name']] = row
+                for alias in row['aliases'].lower().split("|"):
+                    prefix = alias.endswith("*")
+                    alias = alias.rstrip("*").strip()
+                    if alias:
+                        self.automaton.add(alias, (row['variable_name'], prefix))
+        self.automaton.build()
+        self.units: Dict[str, str] = {}
+        # Units that units.csv ties to a variable, and the units each such variable (or one with a default) takes
+        self._unit_variable: Dict[str, str] = {}
+        self._variable_units: Dict[str, Set[str]] = {name: {row['default_unit_name']} for name, row in self.variables.items()
+                                                     if row['default_unit_name']}
+        with open(units_path) as units_csv:
+            for row in csv.DictReader(units_csv):
+                for alias in row['aliases'].lower().split("|"):
+                    if alias:
+                        self.units[alias] = row['unit_name']
+                if row['variable_name']:
+                    self._unit_variable[row['unit_name']] = row['variable_name']
+                    self._variable_units.setdefault(row['variable_name'], set()).add(row['unit_name'])
+        # One group per unit alias, longest first, so the matching group names the unit
+        aliases = sorted(self.units, key=len, reverse=True)
+        self._unit_names = [self.units[alias] for alias in aliases]
+        patterns = [f"({re.escape(alias.rstrip('*'))}" + (r"\w*)" if alias.endswith("*") else ")") for alias in aliases]
+        self._unit: Pattern = re.compile(rf"\s*(?:(?:x|×|times)\s*)?(?:the\s+)?/?(?:{'|'.join(patterns)})(?![a-z0-9])")
+
+    def _hits(self, text: str) -> List[Tuple[int, int, str]]:
+        # Whole-word alias occurrences, leftmost-longest, without overlaps
+        hits = []
+        for start, end, (name, prefix) in self.automaton.search(text):
+            if start > 0 and _is_word(text[start - 1]):
+                continue
+            if prefix:
+                while end < len(text) and _is_word(text[end]):
+                    end += 1
+            elif end < len(text) and _is_word(text[end]):
+                continue
+            hits.append((start, end, name))
+        hits.sort(key=lambda hit: (hit[0], hit[0] - hit[1]))
+        selected: List[Tuple[int, int, str]] = []
+        for hit in hits:
+            if not selected or hit[0] >= selected[-1][1]:
+                selected.append(hit)
+        return selected
+
+    def _unit_at(self, text: str, position: int) -> Optional[str]:
+        match = self._unit.match(text, position)
+        if match is None or match.lastindex is None:
+            return None
+        return self._unit_names[match.lastindex - 1]
+
+    def _fits(self, name: str, unit: Optional[str]) -> bool:
+        if unit is None:
+            return True
+        units = self._variable_units.get(name)
+        if units is not None:
+            return unit in units
+        return self._unit_variable.get(unit, name) == name
+
+    def _numerical(self, name: str, window: str) -> Optional[Dict[str, Any]]:
+        match = _NUMERICAL.match(window)
+        if match is None:
+            return None
+        relation: Dict[str, Any] = {'name': name}
+        if match.group('cmp'):
+            side, inclusive = _COMPARATORS[match.group('cmp')]
+            relation[side] = {'incl': inclusive, 'value': _number(match.group('value'))}
+        elif match.group('low'):
+            relation['lower'] = {'incl': True, 'value': _number(match.group('low'))}
+            relation['upper'] = {'incl': True, 'value': _number(match.group('high'))}
+        else:
+            relation[_TRAILING[match.group('trailing')]] = {'incl': True, 'value': _number(match.group('bare'))}
+            unit = self._unit_at(match.group('bare_unit'), 0)
+            if not self._fits(name, unit):
+                return None
+            if unit:
+                relation['unit'] = unit
+            return relation
+        if window[match.end():match.end() + 2].startswith(("/", ":")) and window[match.end() + 1:match.end() + 2].isdigit():
+            # Ratios such as blood pressure 140/90 or 1:40 are left to the parser
+            return None
+        unit = self._unit_at(window, match.end())
+        if not self._fits(name, unit):
+            return None
+        if unit:
+            relation['unit'] = unit
+        return relation
+
+    def _ordinal(self, name: str, window: str) -> Optional[Dict[str, Any]]:
+        bounds = [int(float(value)) for value in self.variables[name]['bounds'].split("|") if value]
+        match = _NUMERICAL.match(window)
+        values = None
+        if match is not None and match.group('cmp'):
+            side, inclusive = _COMPARATORS[match.group('cmp')]
+            limit = float(_number(match.group('value')))
+            if side == 'lower':
+                values = [value for value in bounds if value > limit or (inclusive and value == limit)]
+            else:
+                values = [value for value in bounds if value < limit or (inclusive and value == limit)]
+        elif match is not None and match.group('low') and not re.search(r"\d\s*(?:,|or)", match.group(0)):
+            low, high = float(match.group('low')), float(match.group('high'))
+            values = [value for value in bounds if low <= value <= high]
+        elif match is not None and match.group('trailing'):
+            limit = float(match.group('bare'))
+            side = _TRAILING[match.group('trailing')]
+            values = [value for value in bounds if (value >= limit if side == 'lower' else value <= limit)]
+        else:
+            listed = _ORDINAL_LIST.match(window)
+            if listed is not None:
+                values = sorted({int(value) for value in re.findall(r"\d+", listed.group('list'))})
+        if not values:
+            return None
+        return {'name': name, 'value': [str(value) for value in values]}
+
+    def _groups(self, text: str) -> Iterator[Tuple[int, int, List[str]]]:
+        # Hits joined only by punctuation or and/or, as in "AST(SGOT)/ALT(SGPT) =< 3 x ULN", share the value after
+        # the last of them: (start of the first hit, end of the last, distinct variables)
+        hits = self._hits(text)
+        index = 0
+        while index < len(hits):
+            start, end, name = hits[index]
+            names = [name]
+            while index + 1 < len(hits) and _CONNECTOR.match(text, end, hits[index + 1][0]):
+                index += 1
+                end = hits[index][1]
+                if hits[index][2] not in names:
+                    names.append(hits[index][2])
+            index += 1
+            yield start, end, names
+
+    def extract(self, eligibility: str) -> Optional[List[Criterion]]:
+        text = eligibility.lower()
+        split = _EXCLUSION.search(text)
+        groups = list(self._groups(text))
+        criteria: List[Criterion] = []
+        for index, (start, end, names) in enumerate(groups):
+            stop = groups[index + 1][0] if index + 1 < len(groups) else len(text)
+            window = text[end:min(stop, end + 120)].split("\n", 1)[0].split(";", 1)[0]
+            eligibility_type = 'exclusion' if split and start > split.start() else 'inclusion'
+            for name in names:
+                variable_type = self.variables[name]['variable_type']
+                if variable_type == 'numerical':
+                    relation = self._numerical(name, window)
+                else:
+                    relation = self._ordinal(name, window)
+                if relation is None:
+                    # A variable mentioned without a readable value: the whole trial goes to the parser
+                    return None
+                criteria.append((variable_type, eligibility_type, relation))
+        return criteria
+
+_extractor: Optional[CriteriaExtractor] = None
+
+def default_extractor() -> CriteriaExtractor:
+    global _extractor
+    if _extractor is None:
+        _extractor = CriteriaExtractor()
+    return _extractor
+
+if __name__ == "__main__":
+    # python criteriaextractor.py <eligibility text file>
+    with open(sys.argv[1]) as eligibility:
+        for criterion in default_extractor().extract(eligibility.read()) or []:
+            print(json.dumps(criterion))
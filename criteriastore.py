@@ -0,0 +1,107 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from hashlib import blake2b
+import sqlite3 as sql
+import threading
+import pickle
+import json
+import time
+import os
+import logging
+
+# One parsed criterion: (variable_type, eligibility_type, decoded relation)
+Criterion = Tuple[str, str, Dict[str, Any]]
+
+def criteria_key(trial_id: str, eligibility: str) -> str:
+    # Content address of a trial's parse: a changed eligibility text gets a new key and is parsed again
+    return f"{trial_id}:{blake2b(eligibility.encode('utf-8'), digest_size=16).hexdigest()}"
+
+def decode_rows(header: str, rows: Iterable[str]) -> List[Criterion]:
+    # Turns the parser's TSV output lines into criteria, decoding each relation once
+    columns = {name.strip(): index for index, name in enumerate(header.split("\t"))}
+    variable_type = columns['variable_type']
+    relation = columns['relation']
+    eligibility_type = columns.get('eligibility_type')
+    criteria: List[Criterion] = []
+    for row in rows:
+        fields = row.rstrip("\n").split("\t")
+        try:
+            criteria.append((fields[variable_type].strip(),
+                             fields[eligibility_type].strip() if eligibility_type is not None else '',
+                             json.loads(fields[relation])))
+        except (IndexError, ValueError) as e:
+            logging.warning(f"Skipping unreadable parser row {row!r}: {e}")
+    return criteria
+
+class CriteriaStore:
+    """Parsed eligibility criteria keyed by `criteria_key`, stored pickled in SQLite.
+
+    Entries are evicted least recently used first once their total size passes `max_bytes`.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sql.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS criteria (key TEXT PRIMARY KEY, body BLOB, size INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS criteria_accessed ON criteria (accessed)")
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, List[Criterion]]:
+        now = time.time()
+        keys = list(keys)
+        found: Dict[str, List[Criterion]] = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start+500]
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f"SELECT key, body FROM criteria WHERE key IN ({marks})", chunk).fetchall()
+                for key, body in rows:
+                    found[key] = pickle.loads(body)
+                if rows:
+                    self.conn.executemany("UPDATE criteria SET accessed=? WHERE key=?", [(now, key) for key, _ in rows])
+        return found
+
+    def get(self, key: str) -> Optional[List[Criterion]]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: Dict[str, List[Criterion]]) -> None:
+        now = time.time()
+        rows = []
+        for key, criteria in items.items():
+            body = pickle.dumps(criteria, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, body, len(body), now))
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO criteria (key, body, size, accessed) VALUES (?, ?, ?, ?)", rows)
+            self._writes += len(rows)
+            if self._writes >= 500:
+                self._writes = 0
+                self._evict()
+
+    def _evict(self) -> None:
+        (total,) = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM criteria").fetchone()
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in self.conn.execute("SELECT key, size FROM criteria ORDER BY accessed").fetchall():
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        logging.info(f"Evicting {len(stale)} parsed trials ({freed} bytes) from {self.path}")
+        self.conn.executemany("DELETE FROM criteria WHERE key=?", stale)
+
+_stores: Dict[str, CriteriaStore] = {}
+
+def open_store(path: str, **kwargs) -> CriteriaStore:
+    store = _stores.get(path)
+    if store is None:
+        store = _stores.setdefault(path, CriteriaStore(path, **kwargs))
+    return store
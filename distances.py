@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 def hav(x):
     a = math.sin(0.5 * x)
@@ -10,4 +11,18 @@ def distance(a, b, r=3958.8):
     b_lat = math.radians(b[0])
     b_long = math.radians(b[1])
     
-    return 2*r * math.asin(math.sqrt(hav(b_lat - a_lat) + (math.cos(a_lat) * math.cos(b_lat) * hav(b_long - a_long))))
\ No newline at end of file
+    return 2*r * math.asin(math.sqrt(hav(b_lat - a_lat) + (math.cos(a_lat) * math.cos(b_lat) * hav(b_long - a_long))))
+
+def haversine(a_lat, a_long, b_lat, b_long, r=3958.8) -> np.ndarray:
+    # Great-circle distances between broadcastable arrays of coordinates in degrees; NaN coordinates give NaN
+    a_lat, a_long, b_lat, b_long = (np.radians(np.asarray(x, dtype=np.float64)) for x in (a_lat, a_long, b_lat, b_long))
+    h = np.sin(0.5 * (b_lat - a_lat)) ** 2 + np.cos(a_lat) * np.cos(b_lat) * np.sin(0.5 * (b_long - a_long)) ** 2
+    return 2*r * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def distance_many(origin, lat, long, r=3958.8) -> np.ndarray:
+    # Distances from one (lat, long) origin to every site
+    return haversine(origin[0], origin[1], lat, long, r)
+
+def distance_matrix(origin_lat, origin_long, lat, long, r=3958.8) -> np.ndarray:
+    # Distances from every origin (rows) to every site (columns)
+    return haversine(np.asarray(origin_lat)[:, None], np.asarray(origin_long)[:, None], lat, long, r)
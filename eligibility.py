@@ -0,0 +1,220 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from constraints import CompiledCriteria, Constraint, IntervalConstraint, SetConstraint, patient_value
+
+ALWAYS, INTERVAL, BITSET, GENERIC = 0, 1, 2, 3
+
+class EligibilityMatrix:
+    """Every candidate trial's constraints packed into flat NumPy columns, one row per constraint.
+
+    Rows are grouped by trial (`offsets[t]:offsets[t + 1]` are trial t's rows, in the order CompiledCriteria
+    evaluates them). Intervals are lower/upper bounds with inclusivity flags, with NaN for a missing side; ordinal
+    sets of small non-negative integers are 64-bit masks. Any other set is tested per row through its object.
+    Exclusion rows invert their interval or set test.
+    """
+
+    def __init__(self, trial_ids: Sequence[str], compiled: Sequence[Optional[CompiledCriteria]]):
+        self.trial_ids = list(trial_ids)
+        self.variables: List[str] = []
+        self.constraints: List[Constraint] = []
+        variable_index: Dict[str, int] = {}
+        trial, variable, kind, bits, exclusion = [], [], [], [], []
+        lower, lower_incl, upper, upper_incl = [], [], [], []
+        offsets = [0]
+        for index, criteria in enumerate(compiled):
+            for name, constraints in (criteria.by_variable.items() if criteria is not None else ()):
+                if name not in variable_index:
+                    variable_index[name] = len(self.variables)
+                    self.variables.append(name)
+                for constraint in constraints:
+                    trial.append(index)
+                    variable.append(variable_index[name])
+                    self.constraints.append(constraint)
+                    row_kind, row_bits = ALWAYS, 0
+                    low, low_incl, high, high_incl = np.nan, False, np.nan, False
+                    if isinstance(constraint, IntervalConstraint):
+                        row_kind = INTERVAL
+                        if constraint.lower is not None:
+                            low, low_incl = constraint.lower, constraint.lower_incl
+                        if constraint.upper is not None:
+                            high, high_incl = constraint.upper, constraint.upper_incl
+                    elif isinstance(constraint, SetConstraint):
+                        row_kind = BITSET
+                        for value in constraint.values:
+                            if value != int(value) or not 0 <= value < 64:
+                                row_kind = GENERIC
+                                break
+                            row_bits |= 1 << int(value)
+                    elif type(constraint) is not Constraint:
+                        row_kind = GENERIC
+                    kind.append(row_kind)
+                    exclusion.append(constraint.exclusion)
+                    bits.append(row_bits if row_kind == BITSET else 0)
+                    lower.append(low)
+                    lower_incl.append(low_incl)
+                    upper.append(high)
+                    upper_incl.append(high_incl)
+            offsets.append(len(trial))
+        self.variable_index = variable_index
+        self.trial = np.array(trial, dtype=np.int64)
+        self.variable = np.array(variable, dtype=np.int64)
+        self.kind = np.array(kind, dtype=np.int8)
+        self.exclusion = np.array(exclusion, dtype=bool)
+        self.bits = np.array(bits, dtype=np.uint64)
+        self.lower = np.array(lower, dtype=np.float64)
+        self.lower_incl = np.array(lower_incl, dtype=bool)
+        self.upper = np.array(upper, dtype=np.float64)
+        self.upper_incl = np.array(upper_incl, dtype=bool)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        # Reverse index: the constraint rows and the trials that test each variable
+        order = np.argsort(self.variable, kind='stable')
+        bounds = np.asarray(np.searchsorted(self.variable[order], np.arange(len(self.variables) + 1)))
+        self.rows_by_variable = [order[bounds[index]:bounds[index + 1]] for index in range(len(self.variables))]
+        self.trials_by_variable = [np.unique(self.trial[rows]) for rows in self.rows_by_variable]
+        self._breakpoints: Dict[int, np.ndarray] = {}
+
+    def breakpoints(self, variable: int) -> np.ndarray:
+        # Sorted distinct values at which some constraint on the variable can change its verdict
+        points = self._breakpoints.get(variable)
+        if points is None:
+            rows = self.rows_by_variable[variable]
+            values = [self.lower[rows], self.upper[rows]]
+            values.extend(np.array(self.constraints[row].values, dtype=np.float64) for row in rows
+                          if self.kind[row] in (BITSET, GENERIC) and isinstance(self.constraints[row], SetConstraint))
+            points = np.unique(np.concatenate(values))
+            points = points[~np.isnan(points)]
+            self._breakpoints[variable] = points
+        return points
+
+    def patient_vector(self, patient_data: Dict[str, Any]) -> np.ndarray:
+        values = np.full(len(self.variables), np.nan)
+        for name, index in self.variable_index.items():
+            if name in patient_data:
+                value = patient_value(patient_data[name])
+                if value is not None:
+                    values[index] = value
+        return values
+
+    def _passed(self, rows: np.ndarray, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Applicable and passed flags of the given constraint rows for their variables' values x
+        applicable = ~np.isnan(x)
+        kind = self.kind[rows]
+        with np.errstate(invalid='ignore'):
+            lower, upper = self.lower[rows], self.upper[rows]
+            above = np.where(self.lower_incl[rows], x >= lower, x > lower) | np.isnan(lower)
+            below = np.where(self.upper_incl[rows], x <= upper, x < upper) | np.isnan(upper)
+            whole = applicable & (x == np.floor(x)) & (x >= 0) & (x < 64)
+            shift = np.where(whole, x, 0).astype(np.uint64)
+        in_set = whole & (((self.bits[rows] >> shift) & np.uint64(1)) == 1)
+        passed = np.select([kind == INTERVAL, kind == BITSET], [above & below, in_set], default=True)
+        passed ^= self.exclusion[rows] & ((kind == INTERVAL) | (kind == BITSET))
+        for position in np.flatnonzero(kind == GENERIC):
+            if applicable[position]:
+                passed[position] = self.constraints[rows[position]].test(float(x[position]))
+        return applicable, passed
+
+    def evaluate(self, patient_data: Dict[str, Any]) -> 'EligibilityResult':
+        values = self.patient_vector(patient_data)
+        rows = np.arange(len(self.constraints))
+        applicable, passed = self._passed(rows, values[self.variable])
+        failed = applicable & ~passed
+        included = np.bincount(self.trial[failed], minlength=len(self.trial_ids)) == 0
+        return EligibilityResult(self, values, included, applicable, passed)
+
+class EligibilityResult:
+    """Outcome of one evaluation: `included` per trial, `applicable` and `passed` per constraint row."""
+
+    def __init__(self, matrix: EligibilityMatrix, values: np.ndarray, included: np.ndarray, applicable: np.ndarray, passed: np.ndarray):
+        self.matrix = matrix
+        self.values = values
+        self.included = included
+        self.applicable = applicable
+        self.passed = passed
+
+    def update(self, patient_data: Dict[str, Any]) -> np.ndarray:
+        # Re-evaluates only the trials testing a variable whose value changed; returns their indices
+        matrix = self.matrix
+        values = matrix.patient_vector(patient_data)
+        changed = np.flatnonzero((values != self.values) & ~(np.isnan(values) & np.isnan(self.values)))
+        self.values = values
+        if len(changed) == 0:
+            return changed
+        rows = np.concatenate([matrix.rows_by_variable[index] for index in changed])
+        self.applicable[rows], self.passed[rows] = matrix._passed(rows, values[matrix.variable[rows]])
+        affected = np.unique(np.concatenate([matrix.trials_by_variable[index] for index in changed]))
+        for index in affected:
+            start, end = matrix.offsets[index], matrix.offsets[index + 1]
+            self.included[index] = not (self.applicable[start:end] & ~self.passed[start:end]).any()
+        return affected
+
+    def what_if(self, variable: str, low: Optional[float] = None, high: Optional[float] = None) -> Dict[str, Any]:
+        """Which trials testing `variable` are eligible as its value sweeps from `low` to `high`.
+
+        The range is cut at the constraints' breakpoints into segments, each a single breakpoint or the open
+        interval between two, over which every verdict is constant. Consecutive segments with the same eligible
+        trials are merged. `gained` and `lost` compare a segment with the verdicts for the current lab values.
+        """
+        matrix = self.matrix
+        index = matrix.variable_index.get(variable)
+        current = None if index is None or np.isnan(self.values[index]) else float(self.values[index])
+        if index is None or len(matrix.rows_by_variable[index]) == 0:
+            return {'variable': variable, 'current': current, 'trials': 0, 'breakpoints': [], 'segments': []}
+        rows = np.sort(matrix.rows_by_variable[index])
+        trials = matrix.trials_by_variable[index]
+        breakpoints = matrix.breakpoints(index)
+        unbounded = len(breakpoints) == 0
+        if unbounded:
+            # No verdict depends on the value (bound-less intervals, empty sets): one segment over the whole range,
+            # evaluated at any point in it
+            inside = breakpoints
+            sample = next((value for value in (low, high, current) if value is not None), 0.0)
+            edges = np.array([sample], dtype=np.float64)
+        else:
+            low = float(breakpoints[0] - 1) if low is None else low
+            high = float(breakpoints[-1] + 1) if high is None else high
+            inside = breakpoints[(breakpoints > low) & (breakpoints < high)]
+            edges = np.unique(np.concatenate([[low, high], inside]))
+        # A point at every edge and one inside every gap between consecutive edges
+        points = np.empty(2 * len(edges) - 1)
+        points[0::2] = edges
+        points[1::2] = (edges[:-1] + edges[1:]) / 2
+
+        # Verdicts of the variable's own constraints at every point, then per trial across its rows
+        _, passed = matrix._passed(np.tile(rows, len(points)), np.repeat(points, len(rows)))
+        passed = passed.reshape(len(points), len(rows))
+        starts = np.flatnonzero(np.r_[True, np.diff(matrix.trial[rows]) != 0])
+        own = np.logical_and.reduceat(passed, starts, axis=1)
+        # ...combined with the verdicts of the trial's constraints on other variables at the current values
+        failed = self.applicable & ~self.passed
+        failed[rows] = False
+        others = np.bincount(matrix.trial[failed], minlength=len(matrix.trial_ids))[trials] == 0
+        eligible = own & others
+
+        now = self.included[trials]
+        trial_ids = matrix.trial_ids
+        segments: List[Dict[str, Any]] = []
+        for position, point in enumerate(points):
+            ids = eligible[position]
+            low_end = float(point) if position % 2 == 0 else float(points[position - 1])
+            high_end = float(point) if position % 2 == 0 else float(points[position + 1])
+            if segments and np.array_equal(ids, segments[-1]['_mask']):
+                segments[-1]['high'] = high_end
+                segments[-1]['high_inclusive'] = position % 2 == 0
+                continue
+            segments.append({'low': low_end, 'low_inclusive': position % 2 == 0, 'high': high_end, 'high_inclusive': position % 2 == 0,
+                             'eligible': int(ids.sum()),
+                             'gained': [trial_ids[t] for t in trials[ids & ~now]],
+                             'lost': [trial_ids[t] for t in trials[~ids & now]],
+                             '_mask': ids})
+        for segment in segments:
+            del segment['_mask']
+        if unbounded:
+            segments[0].update({'low': low, 'low_inclusive': low is not None, 'high': high, 'high_inclusive': high is not None})
+        return {'variable': variable, 'current': current, 'trials': len(trials),
+                'breakpoints': [float(point) for point in inside], 'segments': segments}
+
+    def outcomes(self, index: int) -> List[Tuple[Constraint, bool]]:
+        # The (constraint, satisfied) pairs shown for a trial, as CompiledCriteria.evaluate would return them
+        start, end = self.matrix.offsets[index], self.matrix.offsets[index + 1]
+        constraints = self.matrix.constraints
+        return [(constraints[row], bool(self.passed[row])) for row in range(start, end) if self.applicable[row]]
@@ -1,16 +1,57 @@
-from typing import Tuple, Optional, Dict, Any, Union, List
-from dateutil.parser import parse
-from datetime import datetime
+from typing import Tuple, Optional, Dict, Any, Union, List, Callable
+from fhirdates import parse_optional
+import datetime as dt
 import json
-import jmespath as path
+import pathcompiler as path
 from abc import ABCMeta, abstractmethod
 import logging
+from labtests import labs
 
-class FHIRResource(metaclass=ABCMeta):
+_unset = object()
+
+class _Field:
+    # Non-data descriptor evaluating one of the class's expressions on first access and caching the result in a slot
+
+    def __init__(self, name: str):
+        self.name = name
+        self.slot = f"_{name}"
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot, _unset)
+        if value is _unset:
+            value = obj._extract(self.name)
+            convert = owner.converters.get(self.name)
+            if convert is not None:
+                value = convert(value)
+            setattr(obj, self.slot, value)
+        return value
+
+class _ResourceMeta(ABCMeta):
+    # Gives every class declaring `expressions` a lazy field and a matching slot per expression
+
+    def __new__(mcls, name, bases, namespace):
+        expressions = namespace.get('expressions')
+        if expressions is not None and '__slots__' not in namespace:
+            namespace['__slots__'] = tuple(f"_{key}" for key in expressions)
+            for key in expressions:
+                namespace.setdefault(key, _Field(key))
+        return super().__new__(mcls, name, bases, namespace)
+
+class FHIRResource(metaclass=_ResourceMeta):
+
+    __slots__ = ('_resource',)
 
     expressions: Dict[str, str]
 
-    compiled_expressions: Dict[str, path.parser.ParsedResult] 
+    # Optional conversion applied to an extracted value before it is cached
+    converters: Dict[str, Callable[[Any], Any]] = {}
+
+    # Elements the class reads, sent as _elements so servers that support it can trim each resource
+    elements: List[str] = []
+
+    compiled_expressions: Dict[str, path.CompiledPath]
 
     codeset_from_system: Dict[str, str] = {
         'http://snomed.info/sct': 'SNOMEDCT_US',
@@ -20,15 +61,34 @@ class FHIRResource(metaclass=ABCMeta):
     }
     
     @classmethod
-    def compile_expressions(cls, expressions: Dict[str, str]) -> Dict[str, path.parser.ParsedResult]:
+    def compile_expressions(cls, expressions: Dict[str, str]) -> Dict[str, path.CompiledPath]:
         return {key:path.compile(value) for key,value in expressions.items()}
 
+    @classmethod
+    def search_params(cls) -> Dict[str, str]:
+        # Server-side filters narrowing the search to resources the class can use
+        return {}
+
+    @classmethod
+    def projections(cls) -> List[Dict[str, str]]:
+        # Query parameters to try in order of preference, the last always being a plain search
+        filters = cls.search_params()
+        candidates = []
+        if cls.elements:
+            candidates.append({**filters, '_elements': ','.join(cls.elements)})
+        if filters:
+            candidates.append(filters)
+        candidates.append({})
+        return candidates
+
     def __init__(self, resource: Dict[str, Any]):
         self._resource = resource
-        self.JSON = json.dumps(self._resource, indent=2)
         self.after_init()
 
-    @abstractmethod
+    @property
+    def JSON(self) -> str:
+        return json.dumps(self._resource, indent=2)
+
     def after_init(self) -> None:
         pass
 
@@ -37,25 +97,39 @@ class FHIRResource(metaclass=ABCMeta):
         
 class Observation(FHIRResource):
 
+    # Lazy fields generated from `expressions`, declared for type checkers
+    loinc: Optional[str]
+    value: Optional[float]
+    unit: Optional[str]
+    datetime: Optional[dt.datetime]
+
     expressions = {
         'loinc': "code.coding[?system=='http://loinc.org'].code | [0]",
         'value': 'valueQuantity.value',
         'unit': 'valueQuantity.code',
         'datetime': 'effectiveDateTime'
     }
+
+    elements = ['code', 'valueQuantity', 'effectiveDateTime']
  
+    converters = {
+        'value': lambda value: float(value) if value else None,
+        'datetime': parse_optional
+    }
+
     compiled_expressions = FHIRResource.compile_expressions(expressions)
 
-    def after_init(self):
-        self.loinc: str = self._extract('loinc')
-        value = self._extract('value')
-        self.value: float = float(value) if value else None
-        self.unit: str = self._extract('unit')
-        datetime: str = self._extract('datetime')
-        self.datetime = parse(datetime) if datetime else None
+    @classmethod
+    def search_params(cls) -> Dict[str, str]:
+        return {'code': ','.join(f"http://loinc.org|{loinc}" for loinc in sorted(labs.by_loinc))}
 
 class Demographics(FHIRResource):
 
+    fullname: Optional[str]
+    gender: Optional[str]
+    birth_date: Optional[str]
+    zipcode: Optional[str]
+
     expressions  = {
         'fullname': 'name[0] | text || join(``, [given[0], `" "`, family])',
         'gender': 'gender',
@@ -64,14 +138,13 @@ class Demographics(FHIRResource):
  
     compiled_expressions = FHIRResource.compile_expressions(expressions)
 
-    def after_init(self):
-        self.fullname: str = self._extract('fullname')
-        self.gender: str = self._extract('gender')
-        self.birth_date: str = self._extract('birth_date')
-        self.zipcode: str = self._extract('zipcode')
-
 class Condition(FHIRResource):
 
+    description: Optional[str]
+    code: Optional[str]
+    system: Optional[str]
+    category: Optional[str]
+
     expressions = {
         'description': 'code.text',
         'code': 'code.coding[0].code',
@@ -79,41 +152,56 @@ class Condition(FHIRResource):
         'category': 'category.coding[0].code'
     }
 
+    elements = ['code', 'category']
+
     compiled_expressions = FHIRResource.compile_expressions(expressions)
 
+    @property
+    def codeset(self) -> str:
+        system = self.system
+        if system is None:
+            raise KeyError(f"Condition {self.code} has no coding system")
+        return self.codeset_from_system[system]
+
     def after_init(self):
-        self.description: str = self._extract('description')
-        self.code: str = self._extract('code')
-        self.system: str = self._extract('system')
-        self.codeset: str = self.codeset_from_system[self.system]
-        self.category: str = self._extract('category')
         logging.info(f"Condition {self.description}, category {self.category}")
 
 class MedicationRequest(FHIRResource):
 
+    description: Optional[str]
+    category: Optional[str]
+
     expressions = {
         'description': 'medicationReference.display',
         'category': 'category.coding[0].code'
     }
 
+    elements = ['medicationReference', 'category']
+
     compiled_expressions = FHIRResource.compile_expressions(expressions)
     
     def after_init(self):
-        self.description: str = self._extract('description')
-        self.category: str = self._extract('category')
         logging.info(f"Medication Order {self.description}, category {self.category}")
 
 class ExplanationOfBenefit(FHIRResource):
 
+    diagnoses: Optional[List[Dict[str, str]]]
+
     expressions = {
         'diagnoses': "diagnosis[?diagnosisCodeableConcept.coding[0].code != '9999999'].diagnosisCodeableConcept.coding[0].{code:code, system: system, description:display}"
     }
 
+    elements = ['diagnosis']
+
+    converters = {
+        'diagnoses': lambda diagnoses: _add_codesets(diagnoses)
+    }
+
     compiled_expressions = FHIRResource.compile_expressions(expressions)
 
-    def after_init(self):
-        self.diagnoses: List[Dict[str, str]] = self._extract('diagnoses')
-        if self.diagnoses:
-            logging.warn(f"Processing {len(self.diagnoses)} diagnoses")
-            for diagnosis in self.diagnoses:
-                diagnosis['codeset'] = self.codeset_from_system[diagnosis['system']] 
\ No newline at end of file
+def _add_codesets(diagnoses: Optional[List[Dict[str, str]]]) -> Optional[List[Dict[str, str]]]:
+    if diagnoses:
+        logging.warn(f"Processing {len(diagnoses)} diagnoses")
+        for diagnosis in diagnoses:
+            diagnosis['codeset'] = FHIRResource.codeset_from_system[diagnosis['system']]
+    return diagnoses
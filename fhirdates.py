@@ -0,0 +1,57 @@
+from typing import Optional
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from dateutil.parser import parse
+import logging
+import re
+import timeit
+
+# FHIR date / dateTime / instant: YYYY, YYYY-MM, YYYY-MM-DD, or a full date and time with an optional fraction and offset
+_FHIR_DATETIME = re.compile(
+    r'(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?(Z|[+-]\d{2}:\d{2})?)?)?)?')
+
+_offsets = {'Z': timezone.utc, '+00:00': timezone.utc, '-00:00': timezone.utc}
+
+def _offset(text: str) -> timezone:
+    tz = _offsets.get(text)
+    if tz is None:
+        delta = timedelta(hours=int(text[1:3]), minutes=int(text[4:6]))
+        tz = _offsets.setdefault(text, timezone(-delta if text[0] == '-' else delta))
+    return tz
+
+def _parse_fhir(value: str) -> datetime:
+    match = _FHIR_DATETIME.fullmatch(value)
+    if match is None:
+        raise ValueError(f"Not a FHIR date/dateTime: {value!r}")
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    # Partial dates resolve to the start of the period they name
+    return datetime(int(year), int(month or 1), int(day or 1),
+                    int(hour or 0), int(minute or 0), int(second or 0),
+                    int(fraction[:6].ljust(6, '0')) if fraction else 0,
+                    _offset(offset) if offset else None)
+
+@lru_cache(maxsize=4096)
+def parse_datetime(value: str) -> datetime:
+    """Parses a FHIR date or dateTime, falling back to dateutil for values outside the FHIR grammar."""
+    try:
+        return _parse_fhir(value)
+    except ValueError:
+        logging.debug(f"Falling back to dateutil for timestamp {value!r}")
+        return parse(value)
+
+def parse_optional(value: Optional[str]) -> Optional[datetime]:
+    return parse_datetime(value) if value else None
+
+def _benchmark(number: int = 20000) -> None:
+    samples = ['2019-03-04T10:22:31Z', '2019-03-04T10:22:31.123+05:30', '2019-03-04T10:22:31-04:00', '2019-03-04', '2019-03']
+    for sample in samples:
+        if len(sample) > 7:
+            assert _parse_fhir(sample) == parse(sample), sample
+        slow = timeit.timeit(lambda: parse(sample), number=number)
+        strict = timeit.timeit(lambda: _parse_fhir(sample), number=number)
+        memoised = timeit.timeit(lambda: parse_datetime(sample), number=number)
+        print(f"{sample:<32} dateutil {slow * 1e6 / number:6.2f}us  strict {strict * 1e6 / number:5.2f}us  x{slow / strict:5.1f}"
+              f"  memoised {memoised * 1e6 / number:5.2f}us  x{slow / memoised:6.1f}")
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,165 @@
+from typing import Any, Dict, Iterable, Iterator, Optional
+import codecs
+import json
+import re
+
+_STRUCTURE = re.compile(r'[{}\[\]"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[,}\]\s]')
+_TOKEN = re.compile(r'\S')
+
+class _ValueScanner:
+    # Resumable search for the end of the JSON value starting at `start`; only structural characters are
+    # visited in Python, everything in between is skipped by the regex engine.
+
+    def reset(self, start: int) -> None:
+        self.start = start
+        self.pos = start
+        self.depth = 0
+        self.in_string = False
+        self.started = False
+
+    def shift(self, offset: int) -> None:
+        self.start -= offset
+        self.pos -= offset
+
+    def end(self, buf: str) -> Optional[int]:
+        pos = self.pos
+        if not self.started:
+            c = buf[pos]
+            if c in '{[':
+                self.depth = 1
+            elif c == '"':
+                self.in_string = True
+            else:
+                match = _SCALAR_END.search(buf, pos)
+                return match.start() if match else None
+            self.started = True
+            pos += 1
+        while True:
+            if self.in_string:
+                match = _STRING_SPECIAL.search(buf, pos)
+                if match is None:
+                    self.pos = len(buf)
+                    return None
+                if match.group() == '\\':
+                    if match.end() >= len(buf):
+                        self.pos = match.start()
+                        return None
+                    pos = match.end() + 1
+                    continue
+                self.in_string = False
+                pos = match.end()
+                if self.depth == 0:
+                    return pos
+                continue
+            match = _STRUCTURE.search(buf, pos)
+            if match is None:
+                self.pos = len(buf)
+                return None
+            c = match.group()
+            pos = match.end()
+            if c == '"':
+                self.in_string = True
+            elif c in '{[':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+
+class BundleStream:
+    """Incremental parser for a FHIR Bundle body.
+
+    Iterating yields each `entry[*].resource` as soon as that entry has been received, without decoding the
+    whole bundle; only the entry being received is buffered. Other top-level members (`total`, `link`, ...)
+    are collected in `header` as they go past.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], encoding: str = 'utf-8'):
+        self.chunks = chunks
+        self.header: Dict[str, Any] = {}
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._scanner = _ValueScanner()
+        self._scanning = False
+        self._buf = ''
+        self._state = 'object'
+        self._key = ''
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for chunk in self.chunks:
+            self._buf += self._decoder.decode(chunk)
+            yield from self._parse()
+        self._buf += self._decoder.decode(b'', final=True)
+        yield from self._parse()
+
+    def _complete_value(self, buf: str, pos: int) -> Optional[int]:
+        if not self._scanning:
+            self._scanner.reset(pos)
+            self._scanning = True
+        end = self._scanner.end(buf)
+        if end is not None:
+            self._scanning = False
+        return end
+
+    def _parse(self) -> Iterator[Dict[str, Any]]:
+        buf = self._buf
+        pos = 0
+        while True:
+            match = _TOKEN.search(buf, pos)
+            if match is None:
+                break
+            pos = match.start()
+            c = buf[pos]
+            if self._state == 'object':
+                if c != '{':
+                    raise ValueError(f"Expected a JSON object, found {c!r}")
+                pos += 1
+                self._state = 'key'
+            elif self._state == 'key':
+                if c == ',':
+                    pos += 1
+                elif c == '}':
+                    pos = len(buf)
+                    self._state = 'done'
+                else:
+                    end = self._complete_value(buf, pos)
+                    if end is None:
+                        break
+                    self._key = json.loads(buf[pos:end])
+                    pos = end
+                    self._state = 'colon'
+            elif self._state == 'colon':
+                pos += 1
+                self._state = 'value'
+            elif self._state == 'value':
+                if self._key == 'entry' and c == '[' and not self._scanning:
+                    pos += 1
+                    self._state = 'entries'
+                    continue
+                end = self._complete_value(buf, pos)
+                if end is None:
+                    break
+                self.header[self._key] = json.loads(buf[pos:end])
+                pos = end
+                self._state = 'key'
+            elif self._state == 'entries':
+                if c == ',':
+                    pos += 1
+                elif c == ']':
+                    pos += 1
+                    self._state = 'key'
+                else:
+                    end = self._complete_value(buf, pos)
+                    if end is None:
+                        break
+                    entry = json.loads(buf[pos:end])
+                    pos = end
+                    resource = entry.get('resource') if isinstance(entry, dict) else None
+                    if resource is not None:
+                        yield resource
+            else:
+                pos = len(buf)
+        if self._scanning:
+            self._scanner.shift(pos)
+        self._buf = buf[pos:]
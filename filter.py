@@ -1,8 +1,13 @@
 import logging
 import subprocess
 import os
-import json
-from typing import Any, Dict, Union
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from parserpool import ParserPool
+from criteriaextractor import CriteriaExtractor
+from criteriastore import CriteriaStore, Criterion, criteria_key, decode_rows
+from constraints import CompiledCriteria, compile_criteria, compiled_cache
+from eligibility import EligibilityMatrix
 
 
 value_dict: Dict[str,Dict[str, Any]] = {
@@ -728,86 +733,133 @@ class TestFilter:
 
 
 class FacebookFilter:
-    def __init__(self, mode):
+
+    input_dir = "parser_io/inputs/"
+    output_dir = "parser_io/outputs/"
+    header = "#nct_id,title,has_us_facility,conditions,eligibility_criteria"
+
+    def __init__(self, mode, pool: Optional[ParserPool] = None, store: Optional[CriteriaStore] = None,
+                 extractor: Optional[CriteriaExtractor] = None):
         self.mode = mode
+        self.pool = pool
+        self.store = store
+        self.extractor = extractor
+        self.parsed: Dict[str, List[Criterion]] = {}
+
+    @staticmethod
+    def _key(trial) -> str:
+        return criteria_key(trial.id, trial.eligibility_combined)
+
+    @staticmethod
+    def _input_line(trial) -> str:
+        title = '"' + trial.title.replace('"', "'") + '"'
+        return trial.id + "," + title + ",false,disease," + trial.eligibility_combined
 
     def generate_results(self, trial):
-        logging.info(f"Parsing trial {trial.id}")
-        input_line = "parser_io/inputs/" + trial.id + ".csv"
-        output_line = "parser_io/outputs/" + trial.id + ".csv"
+        self.generate_batch([trial])
+
+    def generate_batch(self, trials: Iterable) -> None:
+        # Loads the parsed criteria of every trial with one store lookup, extracts what it can in process and
+        # parses the rest in a single pass
+        wanted = {self._key(trial): trial for trial in trials if trial.eligibility_combined}
+        wanted = {key: trial for key, trial in wanted.items() if key not in self.parsed and compiled_cache.get(key) is None}
+        if not wanted:
+            return
+        if self.store is not None:
+            self.parsed.update(self.store.get_many(wanted))
+        pending = {trial.id: trial for key, trial in wanted.items() if key not in self.parsed}
+        parsed: Dict[str, List[Criterion]] = {}
+        if self.extractor is not None:
+            for trial_id, trial in list(pending.items()):
+                criteria = self.extractor.extract(trial.eligibility_combined)
+                if criteria is not None:
+                    parsed[self._key(trial)] = criteria
+                    del pending[trial_id]
+            logging.info(f"Extracted criteria of {len(parsed)} trials, {len(pending)} left to the parser")
+        if pending:
+            if self.pool is not None:
+                logging.info(f"Parsing {len(pending)} trials on {len(self.pool.workers)} parser workers")
+                outputs = self.pool.parse_many((trial.id, trial.title, trial.eligibility_combined) for trial in pending.values())
+            else:
+                outputs = self._run_parser(pending)
+            parsed.update((self._key(pending[trial_id]), decode_rows(header, rows)) for trial_id, (header, rows) in outputs.items())
+        self.parsed.update(parsed)
+        if self.store is not None and parsed:
+            self.store.put_many(parsed)
 
-        header = "#nct_id,title,has_us_facility,conditions,eligibility_criteria"
-        trial_info = trial.id + "," + trial.title + ",false,disease," + trial.eligibility_combined
-        print(header + "\n" + trial_info, file=open(input_line, "w"))
+    def _run_parser(self, trials: Dict[str, Any]) -> Dict[str, Tuple[str, List[str]]]:
+        logging.info(f"Parsing {len(trials)} trials in one batch")
+        batch = uuid.uuid4().hex
+        input_line = f"{self.input_dir}batch-{batch}.csv"
+        output_line = f"{self.output_dir}batch-{batch}.tsv"
+        with open(input_line, "w") as input_csv:
+            print(self.header, file=input_csv)
+            for trial in trials.values():
+                print(self._input_line(trial), file=input_csv)
 
         command_line = ['parser_io/cfg', '-conf', 'parser_io/cfg.conf', '-o', output_line,
                         '-i', input_line]
+        try:
+            subprocess.run(command_line)
+            if not os.path.exists(output_line):
+                logging.warning(f"Parser produced no output for batch {batch}")
+                return {}
+            with open(output_line, "r") as output_csv:
+                return self._split_output(output_csv.readlines(), trials)
+        finally:
+            for path in (input_line, output_line):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    @staticmethod
+    def _split_output(lines: List[str], trials: Dict[str, Any]) -> Dict[str, Tuple[str, List[str]]]:
+        # Demultiplexes the combined parser output by #nct_id
+        if not lines:
+            return {}
+        header = lines[0].rstrip("\n")
+        columns = [column.strip() for column in header.split("\t")]
+        id_column = columns.index("#nct_id") if "#nct_id" in columns else 0
+        rows_by_trial: Dict[str, List[str]] = {trial_id: [] for trial_id in trials}
+        for line in lines[1:]:
+            rows = rows_by_trial.get(line.split("\t")[id_column].strip())
+            if rows is not None:
+                rows.append(line.rstrip("\n"))
+        return {trial_id: (header, rows) for trial_id, rows in rows_by_trial.items()}
+
+    def compiled(self, key: str) -> Optional[CompiledCriteria]:
+        compiled = compiled_cache.get(key)
+        if compiled is None and key in self.parsed:
+            compiled = compile_criteria(self.parsed[key], value_dict)
+            compiled_cache.put(key, compiled)
+        return compiled
+
+    def matrix(self, trials: List) -> EligibilityMatrix:
+        self.generate_batch(trials)
+        return EligibilityMatrix([trial.id for trial in trials],
+                                 [self.compiled(self._key(trial)) if trial.eligibility_combined else None for trial in trials])
 
-        subprocess.run(command_line)
+    def filter_trials(self, trials: List, patient_data) -> List[bool]:
+        # Vectorised filter_trial over all trials; each trial's filter_condition is replaced with its outcomes
+        result = self.matrix(trials).evaluate(patient_data)
+        for index, trial in enumerate(trials):
+            trial.filter_condition = result.outcomes(index)
+        return [bool(included) for included in result.included]
 
     def filter_trial(self, trial, patient_data) -> bool:
         logging.info(patient_data)
-        output_line = "parser_io/outputs/" + trial.id + ".csv"
         if trial.eligibility_combined == "" or trial.eligibility_combined is None:
             return True
-        if not os.path.exists(output_line):
+        key = self._key(trial)
+        if key not in self.parsed and compiled_cache.get(key) is None:
             self.generate_results(trial)
         else:
             logging.info(f"Cached parsed trial {trial.id}")
 
-        obj = {}
-        elg = True
-        if os.path.exists(output_line):
-            with open(output_line, "r") as output_csv:
-                output_csv_lines = output_csv.readlines()
-                output_split = [line.split("\t") for line in output_csv_lines]
-
-                for i in range(len(output_split[0])):
-                    obj[output_split[0][i].strip()] = [split[i] for split in output_split[1:]]
-
-                for i in range(len(output_split) - 1):
-                    var_type = obj['variable_type'][i]
-                    json_obj = json.loads(obj['relation'][i])
-                    consists = True
-                    found = False
-                    filter_condition = ""
-
-                    for value_type in value_dict:
-                        if value_dict[value_type]['variable_name'] not in patient_data:
-                            continue
-                        if json_obj['name'] == value_type:
-                            found = True
-                            filter_condition += value_dict[value_type]['display_name'] + ": "
-                            lab_val = patient_data[value_dict[value_type]['variable_name']]
-                            if var_type == 'numerical':
-                                if 'lower' in json_obj:
-                                    val = float(json_obj['lower']['value'].replace(' ', ''))
-                                    filter_condition += "Must be greater than " + str(val) + ". "
-                                    if json_obj['lower']['incl'] and float(lab_val) < val:
-                                        consists = False
-                                    if not json_obj['lower']['incl'] and float(lab_val) <= val:
-                                        consists = False
-                                if 'upper' in json_obj:
-                                    val = float(json_obj['upper']['value'].replace(' ', ''))
-                                    filter_condition += "Must be less than " + str(val) + ". "
-                                    if json_obj['upper']['incl'] and float(lab_val) > val:
-                                        consists = False
-                                    if not json_obj['upper']['incl'] and float(lab_val) >= val:
-                                        consists = False
-                            elif var_type == 'ordinal':
-                                allowed_values = [float(val.replace(' ', '')) for val in json_obj.value]
-                                filter_condition += "Must be one of: " + ", ".join(
-                                    [str(value) for value in allowed_values])
-                                if float(lab_val) not in allowed_values:
-                                    consists = False
-
-                    if not found:
-                        continue
-
-                    if not consists:
-                        elg = False
-
-                    trial.filter_condition.append((filter_condition, consists))
+        compiled = self.compiled(key)
+        if compiled is None:
+            return True
+        elg, outcomes = compiled.evaluate(patient_data)
+        trial.filter_condition.extend(outcomes)
         if elg:
             logging.info('passed')
             return True
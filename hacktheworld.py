@@ -3,19 +3,24 @@ import logging
 import sys
 import umls
 import requests as req
-from typing import Dict, List, Optional, Union, Iterable, Match, Set, Callable, Type, cast, Tuple, Any
+from typing import Dict, List, Optional, Union, Iterable, Match, Set, Callable, Type, cast, Tuple, Any, Sequence
 from abc import ABCMeta, abstractmethod
 from mypy_extensions import TypedDict
 from datetime import date
-from distances import distance
-from zipcode import Zipcode
+from siteindex import SiteIndex
+from zipcode import open_zipcodes
 from flask import current_app as app
 from apis import VaApi, CmsApi, FhirApi, UmlsApi, NciApi, FbApi
 from filter import FacebookFilter
+from parserpool import pool_from_config
+from criteriastore import open_store as open_criteria_store
+from criteriaextractor import default_extractor
+from eligibility import EligibilityResult
 from fhir import Observation
 from labtests import labs, LabTest
+from observations import ObservationStore
 from datetime import datetime
-from gevent import spawn, iwait, pool
+from gevent import spawn, iwait
 import os
 import subprocess
 import json
@@ -28,9 +33,8 @@ class Patient(metaclass=ABCMeta):
         #logging.geaLogger().setLevel(logging.DEBUG)
         self.mrn = mrn
         self.token = token
-        self.auth = umls.Authentication(app.config["UMLS_API_KEY"])
-        self.tgt = self.auth.gettgt()
-        self.results: List[TestResult] = []
+        umls.tickets(app.config["UMLS_API_KEY"]).warm()
+        self.observations = ObservationStore()
         self.medication_orders: List
         self.latest_results: Dict[str, TestResult] = {}
         self.api = self.api_factory(self.mrn, self.token)
@@ -137,10 +141,8 @@ class Patient(metaclass=ABCMeta):
         # logging.info("Trials found")
 
         code_results = {}
-        gpool = pool.Pool(10)
         for ncit_code in self.codes_ncit:
-            gpool.wait_available()
-            code_results[gpool.spawn(pt.find_new_trails, ncit_code, app.config['ADDITIONAL_TRIALS_URL'])] = ncit_code
+            code_results[spawn(pt.find_new_trails, ncit_code, app.config['ADDITIONAL_TRIALS_URL'])] = ncit_code
 
         for code_result in iwait(code_results):
             ncit_code = code_results[code_result]
@@ -216,17 +218,17 @@ class VAPatient(Patient):
         logging.info("Conditions loaded")
 
     def load_test_results(self) -> None:
-        self.results = []
+        self.observations = ObservationStore()
         for obs in self.va_api.get_observations():
             app.logger.debug(f"LOINC CODE = {obs.loinc}")
             result = TestResult.from_observation(obs)
             if result is not None:
                 app.logger.debug(f"Result added: {result.test_name} {result.value} {result.unit} on {result.datetime}")
-                self.results.append(result)
-                # Determine if result is the latest
-                existing_result = self.latest_results.get(result.test_name)
-                if existing_result is None or existing_result.datetime < result.datetime:
-                    self.latest_results[result.test_name] = result
+                self.observations.append(result.test_name, result.value, result.unit, result.datetime)
+        for test_name in self.observations.tests:
+            latest = self.observations.latest(test_name)
+            if latest is not None:
+                self.latest_results[test_name] = TestResult(test_name, latest[2], latest[0], latest[1])
         self.medication_orders = []
         # TODO: go through medication orders and 
         #for order in self.va_api.get_medication_orders():
@@ -392,68 +394,51 @@ class CombinedPatient:
         self.ncit_codes: list = []
         self.trials_by_ncit: list = []
         self.ncit_without_trials: list = []
-        self.results: List[TestResult] = []
+        self.observations = ObservationStore()
         self.latest_results: Dict[str, TestResult] = {}
         self.conditions_by_code: Dict[str, Dict[str, str]] = {}
         self.no_matches: set = set()
         self.code_matches: Dict[str, Dict[str, str]] = {}
+        self.candidates_by_ncit: List[Dict[str, Any]] = []
+        self.eligibility: Optional[EligibilityResult] = None
+        self.origin: Optional[Tuple[float, float]] = None
+        self.site_index: Optional[SiteIndex] = None
         # Deprecate the following collections:
         self.matches: list = []
         self.codes_without_matches: list = []
 
     def calculate_distances(self):
-        db = Zipcode()
+        db = open_zipcodes()
         if self.from_source.get('va'):
             patzip = self.from_source['va'].zipcode[:5]
         elif self.from_source.get('cms'):
             patzip = self.from_source['cms'].zipcode[:5]
         else:
             return
-        pat_latlong = db.zip2geo(patzip)
-        logging.debug(f"Zipcode {patzip}, pat_latlong: {pat_latlong}")
-
-        logging.debug(f"Checking distances for {len(self.trials)} trials")
-        for trial in self.trials:
-            if trial.sites is None:
-                logging.debug(f"Site list empty for trial {trial.id}")
-            else:
-                logging.debug(f"Trial {trial.id} has {len(trial.sites)} sites")
-                for site in trial.sites:
-                    coordinates = site.get("org_coordinates", 0)
-                    logging.debug(f"Coordinates: {coordinates}")
-                    if coordinates == 0:
-                        zipcode = site.get('org_postal_code', '')
-                        zipcode = '' if zipcode is None else zipcode
-                        site_latlong = db.zip2geo(zipcode[:5])
-                        logging.debug(f"site lat-long (from zip): {site_latlong}")
-                    else:
-                        site_latlong = (coordinates["lat"], coordinates["lon"])
-                        logging.debug(f"site lat-long (from coords): {site_latlong}")
-                    if (site_latlong is None) or (pat_latlong is None):
-                        logging.debug(f"no distance for site {site['org_name']} at trial={trial.id}")
-                    else:
-                        site["distance"] = distance(pat_latlong, site_latlong)
-                        logging.debug(f"Distance={site['distance']} for Trial={trial.id}")
-
-            if trial.locations is None:
-                logging.debug(f"Location list empty for trial {trial.id}")
-            else:
-                logging.debug(f"Trial {trial.id} has {len(trial.locations)} locations")
-                for site in trial.locations:
-                    site_latlong = db.zip2geo(site.get("LocationZip", "00000")[:5])
-                    logging.debug(f"site lat-long (from zip): {site_latlong}")
-                    if (site_latlong is None) or (pat_latlong is None):
-                        logging.debug(f"no distance for site {site.get('LocationFacility', 'unknown')} at trial={trial.id}")
-                    else:
-                        site["distance"] = distance(pat_latlong, site_latlong)
-                        logging.debug(f"Distance={site['distance']} for Trial={trial.id}")
+        self.origin = db.zip2geo(patzip)
+        logging.debug(f"Zipcode {patzip}, pat_latlong: {self.origin}")
+        if self.origin is None:
+            return
+        self.site_index = SiteIndex.from_trials(self.trials, db)
+        logging.debug(f"Indexed {len(self.site_index)} sites of {len(self.trials)} trials")
+        for site, miles in zip(self.site_index.sites, self.site_index.distances_from(self.origin)):
+            site["distance"] = float(miles)
+
+    def nearby_trials(self, miles: Optional[float] = None, count: Optional[int] = None) -> Optional[Dict[str, Tuple[float, Dict[str, Any]]]]:
+        # Each trial's nearest site and its distance, nearest trial first: those within `miles`, and only the
+        # nearest `count` if given. None when the patient's location is unknown.
+        if self.site_index is None or self.origin is None:
+            return None
+        if count is not None:
+            return self.site_index.nearest_trials(self.origin, count, miles)
+        return self.site_index.nearest_by_trial(self.origin, miles)
 
     def load_data(self):
         self.clear_collections()
         for source, patient in self.from_source.items():
             self.append_patient_data(patient)
             if source=='va':
-                self.results = patient.results
+                self.observations = patient.observations
         self.calculate_distances()
         for code in self.ncit_codes:
             trials = []
@@ -473,7 +458,7 @@ class CombinedPatient:
         if va_patient is None:
             return
         va_patient.load_test_results()
-        self.results = va_patient.results
+        self.observations = va_patient.observations
         self.latest_results = va_patient.latest_results
 
     def append_patient_data(self,patient):
@@ -493,27 +478,57 @@ class CombinedPatient:
         self.matches += patient.matches
         self.codes_without_matches += patient.codes_without_matches
 
-    def filter_by_criteria(self, form) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
-        trials_by_ncit = self.trials_by_ncit
-        if form.validate_on_submit():
+    def lab_values(self, form=None) -> Dict[str, Any]:
+        if form is not None and form.validate_on_submit():
             lab_results = {key: value for (key, value) in form.data.items() if key != 'csrf_token'}
             for lab in self.latest_results:
                 if lab not in lab_results:
                     lab_results[lab] = self.latest_results[lab]
+            return lab_results
+        return self.latest_results
+
+    def filter_by_criteria(self, form) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        return self.apply_lab_values(self.lab_values(form))
+
+    def add_lab_result(self, variable: str, result: 'TestResult') -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        self.latest_results[variable] = result
+        return self.apply_lab_values(self.lab_values())
+
+    def what_if(self, variable: str, low: Optional[float] = None, high: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        # Read-only: None until a filter pass has built the eligibility result, since running one here would change
+        # the criteria shown with the trials
+        if self.eligibility is None:
+            return None
+        return self.eligibility.what_if(variable, low, high)
+
+    def apply_lab_values(self, lab_results: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        # The first pass evaluates every candidate trial; later passes re-evaluate only the trials whose criteria
+        # test a lab value that changed since, and patch their verdicts into the cached result
+        if self.eligibility is None:
+            self.candidates_by_ncit = self.trials_by_ncit
+            candidates = [trial for condition in self.candidates_by_ncit for trial in condition['trials']]
+            store = open_criteria_store(app.config['CRITERIA_STORE_PATH'], max_bytes=app.config['CRITERIA_STORE_MAX_BYTES'])
+            extractor = default_extractor() if app.config['CRITERIA_EXTRACTOR'] else None
+            cfg = FacebookFilter('cfg', pool_from_config(app.config), store, extractor)
+            self.eligibility = cfg.matrix(candidates).evaluate(lab_results)
+            affected: Sequence[int] = range(len(candidates))
         else:
-            lab_results = self.latest_results
+            candidates = [trial for condition in self.candidates_by_ncit for trial in condition['trials']]
+            affected = list(self.eligibility.update(lab_results))
+            logging.info(f"Lab values changed, re-evaluated {len(affected)} of {len(candidates)} trials")
+        for index in affected:
+            candidates[index].filter_condition = self.eligibility.outcomes(index)
 
         filtered_trials_by_ncit = []
         excluded_trials_by_ncit = []
-        cfg = FacebookFilter('cfg')
-
-        for condition in trials_by_ncit:
+        verdicts = iter(self.eligibility.included)
+        for condition in self.candidates_by_ncit:
             ncit = condition['ncit']
             trials = condition['trials']
             inc = []
             exc = []
             for trial in trials:
-                if cfg.filter_trial(trial, lab_results):
+                if next(verdicts):
                     inc.append(trial)
                 else:
                     exc.append(trial)
@@ -0,0 +1,37 @@
+from typing import Deque, Dict, Optional
+from collections import deque
+
+class LatencyTracker:
+    """Sliding window of recent response latencies for one host, used to pick the hedging delay."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20, quantile: float = 0.95):
+        self.window = window
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._since_sorted = 0
+        self._cached: Optional[float] = None
+
+    def record(self, elapsed: float) -> None:
+        self._samples.append(elapsed)
+        self._since_sorted += 1
+
+    def threshold(self) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._cached is None or self._since_sorted >= self.min_samples:
+            ordered = sorted(self._samples)
+            self._cached = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+            self._since_sorted = 0
+        return self._cached
+
+class HedgeStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self.denied = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {'hedgeable': self.requests, 'hedges_fired': self.fired, 'hedges_won': self.won, 'hedges_denied': self.denied}
@@ -0,0 +1,230 @@
+from typing import Callable, Dict, Optional, Tuple, Union, Any
+from urllib.parse import urlsplit
+from flask import current_app as app, has_app_context
+import requests as req
+from requests.adapters import HTTPAdapter
+import concurrency
+from hedging import LatencyTracker, HedgeStats
+from gevent import spawn, wait
+from retry import RetryPolicy, CircuitBreaker, RetryBudget, RETRY_STATUSES
+import threading
+import time
+import logging
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT: Tuple[float, float] = (5.0, 60.0)
+
+class HostPool:
+    """Keep-alive session for a single upstream host."""
+
+    def __init__(self, host: str, size: int, timeout: Union[float, Tuple[float, float]], breaker: CircuitBreaker, budget: RetryBudget,
+                 hedge_budget: RetryBudget):
+        self.host = host
+        self.size = size
+        self.timeout = timeout
+        self.breaker = breaker
+        self.budget = budget
+        self.hedge_budget = hedge_budget
+        self.latency = LatencyTracker()
+        self.hedges = HedgeStats()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self.session = req.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> req.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        # urllib3 counts every connection it opens and every request it sends on a pool
+        opened = 0
+        sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return {'size': self.size, 'opened': opened, 'reused': max(sent - opened, 0), 'requests': sent,
+                'circuit': self.breaker.state, 'retry_tokens': int(self.budget.tokens), **self.hedges.as_dict()}
+
+class HttpClient:
+    """Process-wide registry of pooled sessions, one per upstream host."""
+
+    idempotent_methods = {'GET', 'HEAD', 'OPTIONS'}
+
+    def __init__(self):
+        self._pools: Dict[str, HostPool] = {}
+        self._lock = threading.Lock()
+        self._policy: Optional[RetryPolicy] = None
+        self._settings: Optional[Dict[str, Any]] = None
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        # Settings captured at startup, since requests are also made from greenlets without an app context
+        self._settings = config
+        self._policy = None
+
+    def _config(self, key: str, default: Any) -> Any:
+        if self._settings is not None:
+            return self._settings.get(key, default)
+        return app.config.get(key, default) if has_app_context() else default
+
+    def pool_for(self, url: str) -> HostPool:
+        host = urlsplit(url).netloc
+        pool = self._pools.get(host)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(host)
+                if pool is None:
+                    sizes: Dict[str, int] = self._config('HTTP_POOL_SIZES', {})
+                    size = sizes.get(host, self._config('HTTP_DEFAULT_POOL_SIZE', DEFAULT_POOL_SIZE))
+                    timeout = self._config('HTTP_TIMEOUT', DEFAULT_TIMEOUT)
+                    logging.info(f"Opening connection pool for {host} with size {size}")
+                    breaker = CircuitBreaker(host, self._config('CIRCUIT_FAILURE_THRESHOLD', 5), self._config('CIRCUIT_RESET_TIMEOUT', 30.0))
+                    budget = RetryBudget(self._config('RETRY_BUDGET_RATIO', 0.2))
+                    hedge_budget = RetryBudget(self._config('HEDGE_BUDGET_RATIO', 0.05), self._config('HEDGE_BUDGET_BURST', 5.0))
+                    pool = HostPool(host, size, timeout, breaker, budget, hedge_budget)
+                    self._pools[host] = pool
+        return pool
+
+    def policy(self) -> RetryPolicy:
+        if self._policy is None:
+            self._policy = RetryPolicy(self._config('RETRY_MAX_ATTEMPTS', 4), self._config('RETRY_BASE_DELAY', 0.5),
+                                       self._config('RETRY_MAX_DELAY', 10.0))
+        return self._policy
+
+    def _send(self, pool: HostPool, method: str, url: str, **kwargs) -> req.Response:
+        with concurrency.controller.slot(url) as outcome:
+            start = time.monotonic()
+            response = pool.request(method, url, **kwargs)
+            outcome.status = response.status_code
+            if kwargs.get('stream'):
+                # The body is still to be read over the connection, so the slot is held until then
+                outcome.hold()
+                _release_with(response, outcome.release)
+        if response.status_code < 500:
+            pool.latency.record(time.monotonic() - start)
+        return response
+
+    def _hedged_send(self, pool: HostPool, method: str, url: str, **kwargs) -> req.Response:
+        # Issue a duplicate once the primary outlives the host's p95 latency; the first response wins
+        pool.hedges.requests += 1
+        pool.hedge_budget.deposit()
+        threshold = pool.latency.threshold()
+        if threshold is None:
+            return self._send(pool, method, url, **kwargs)
+        primary = spawn(self._send, pool, method, url, **kwargs)
+        primary.join(timeout=threshold)
+        if primary.ready():
+            return primary.get()
+        if not pool.hedge_budget.withdraw():
+            pool.hedges.denied += 1
+            return primary.get()
+        pool.hedges.fired += 1
+        logging.info(f"Hedging {method} {url} after {threshold:.2f}s")
+        hedge = spawn(self._send, pool, method, url, **kwargs)
+        winner = wait([primary, hedge], count=1)[0]
+        other = hedge if winner is primary else primary
+        if not winner.successful():
+            winner, other = other, winner
+        other.kill(block=False)
+        if other.ready() and other.successful():
+            other.value.close()
+        response = winner.get()
+        if winner is hedge:
+            pool.hedges.won += 1
+        return response
+
+    def request(self, method: str, url: str, hedge: bool = False, **kwargs) -> req.Response:
+        pool = self.pool_for(url)
+        policy = self.policy()
+        retryable = method.upper() in self.idempotent_methods
+        hedge = hedge and retryable and self._config('HEDGE_ENABLED', False)
+        attempt = 0
+        while True:
+            if not pool.breaker.allow():
+                logging.warning(f"Circuit for {pool.host} is open, failing fast on {url}")
+                return _circuit_open_response(url)
+            # Past allow() with the circuit not closed, this call is the half-open probe
+            probe = pool.breaker.opened_at is not None
+            try:
+                if hedge:
+                    response = self._hedged_send(pool, method, url, **kwargs)
+                else:
+                    response = self._send(pool, method, url, **kwargs)
+            except req.RequestException as exc:
+                pool.breaker.record_failure()
+                if not (retryable and attempt + 1 < policy.max_attempts and pool.budget.withdraw()):
+                    raise
+                delay = policy.delay(attempt)
+                logging.warning(f"{method} {url} failed ({exc}), retrying in {delay:.2f}s")
+            except BaseException:
+                # Killed (GreenletExit from killall or a lost hedge) or crashed before an outcome was recorded
+                if probe:
+                    pool.breaker.cancel_probe()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    pool.breaker.record_success()
+                    pool.budget.deposit()
+                    return response
+                pool.breaker.record_failure()
+                if not (retryable and attempt + 1 < policy.max_attempts and pool.budget.withdraw()):
+                    return response
+                delay = policy.delay(attempt, response.headers.get('Retry-After'))
+                logging.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.2f}s")
+                response.close()
+            attempt += 1
+            time.sleep(delay)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {host: pool.stats() for host, pool in list(self._pools.items())}
+
+def _release_with(response: req.Response, release: Callable[[], None]) -> None:
+    # Calls `release` once the body has been read to the end (urllib3 then returns the connection) or the
+    # response is closed
+    raw_release = getattr(response.raw, 'release_conn', None)
+    if raw_release is not None:
+        def release_conn() -> None:
+            try:
+                raw_release()
+            finally:
+                release()
+        response.raw.release_conn = release_conn
+    close = response.close
+
+    def close_and_release() -> None:
+        try:
+            close()
+        finally:
+            release()
+    response.close = close_and_release  # type: ignore
+
+def _circuit_open_response(url: str) -> req.Response:
+    # Synthetic 503 so callers handle an open circuit exactly like an unavailable upstream
+    response = req.Response()
+    response.status_code = 503
+    response.reason = 'Circuit open'
+    response.url = url
+    response._content = b''
+    return response
+
+client = HttpClient()
+
+def configure(config: Dict[str, Any]) -> None:
+    client.configure(config)
+    concurrency.controller.configure(config)
+
+def request(method: str, url: str, **kwargs) -> req.Response:
+    return client.request(method, url, **kwargs)
+
+def get(url: str, params: Optional[Any] = None, **kwargs) -> req.Response:
+    return client.request('GET', url, params=params, **kwargs)
+
+def post(url: str, data: Optional[Any] = None, **kwargs) -> req.Response:
+    return client.request('POST', url, data=data, **kwargs)
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return client.stats()
@@ -4,17 +4,17 @@ import logging
 import binascii
 import os
 import ndjson
-import requests
+import httpclient
+from retry import RetryPolicy
 import tempfile
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from Crypto.Cipher import PKCS1_OAEP, AES
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
-from requests import request
 from jsonpath_rw_ext import parse
 from base64 import b64encode
 from typing import Dict, List, Any
-from umls import Authentication
+from umls import Authentication, tickets
 from flask import current_app as app
 
 GCM_NONCE_SIZE = 12
@@ -24,6 +24,10 @@ EXPORT_URL = 'https://sandbox.bcda.cms.gov/api/v1/{data_type}/$export'
 CLINICAL_TRIALS_URL = 'https://clinicaltrialsapi.cancer.gov/v1/clinical-trial/'
 CROSS_WALK_URL = 'https://uts-ws.nlm.nih.gov/rest/crosswalk/current/source/'
 
+# BCDA export jobs take seconds to minutes; poll quickly at first and back off, honouring Retry-After. Equal jitter
+# keeps every wait at least half the backoff so polling never degenerates into a tight loop
+job_poll_policy = RetryPolicy(max_attempts=30, base_delay=1.0, max_delay=15.0, jitter='equal')
+
 
 def get_authenticate_bcda_api_token(client_id: str, client_secret: str):
     token_url = f'{BCDA_URL}auth/token'
@@ -32,7 +36,7 @@ def get_authenticate_bcda_api_token(client_id: str, client_secret: str):
         'Authorization': f'Basic {encoded_auth}'
     }
     try:
-        response = request("POST", token_url, headers=headers)
+        response = httpclient.request("POST", token_url, headers=headers)
         response.raise_for_status()
         bearer_token = response.json().get('access_token', '')
     except Exception as e:
@@ -71,11 +75,11 @@ def submit_get_patients_job(url: str, token: str) -> List:
     }
     job_attempts = 0
     try:
-        response = request("GET", url, headers=submit_header)
+        response = httpclient.request("GET", url, headers=submit_header)
         response.raise_for_status()
         job_url = response.headers['Content-Location']
         while job_attempts < 30:
-            job_response = request('GET', job_url, headers={
+            job_response = httpclient.request('GET', job_url, headers={
                 'Authorization': f'Bearer {token}'
             })
             job_attempts += 1
@@ -86,8 +90,9 @@ def submit_get_patients_job(url: str, token: str) -> List:
                     patients = get_patients(output[0], token)
                     print('job_done')
                     return patients
-            print(f'response code {job_response.status_code} Waiting 2sec  for the job to complete')
-            sleep(2)
+            delay = job_poll_policy.delay(job_attempts, job_response.headers.get('Retry-After'))
+            print(f'response code {job_response.status_code} Waiting {delay:.1f}sec for the job to complete')
+            sleep(delay)
         raise Exception(f'Failed to get response from the url: {job_url} after {job_attempts} attempts')
     except Exception as exc:
         print(f'Failed due to : {exc}')
@@ -98,7 +103,7 @@ def get_patients(body: Dict, token: str) -> List:
     encrypted_key = body['encryptedKey']
     patients_url = body['url']
     file_name = patients_url.split('/')[-1]
-    response = request('GET', patients_url, headers={
+    response = httpclient.request('GET', patients_url, headers={
         'Authorization': f'Bearer {token}'
     })
     tmp_dir = tempfile.mkdtemp()
@@ -165,7 +170,7 @@ def get_infected_patients_info(token: str):
 
 def get_nci_thesaurus_concept_ids(code: str):
     try:
-        diseases = requests.get(CLINICAL_TRIALS_URL+code).json()['diseases']
+        diseases = httpclient.get(CLINICAL_TRIALS_URL+code).json()['diseases']
         nci_thesaurus_concept_ids = [disease['nci_thesaurus_concept_id'] for disease in diseases]
     except Exception as exc:
         raise Exception(exc)
@@ -194,10 +199,9 @@ def process_codes(auth: 'Authentication', nci_thesaurus_concept_id: str):
     codeset = 'NCI'
     url = f'{CROSS_WALK_URL}{codeset}/'
     params = {'targetSource': 'ICD9CM'}
-    target = auth.gettgt()
-    ticket = auth.getst(target)
+    ticket = tickets(auth.apikey).service_ticket()
     params['ticket'] = ticket
-    res = requests.get(url + nci_thesaurus_concept_id, params=params)
+    res = httpclient.get(url + nci_thesaurus_concept_id, params=params)
     icd_codes = []
     try:
         res.raise_for_status()
@@ -0,0 +1,106 @@
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timezone
+import time
+import numpy as np
+
+SECONDS_PER_DAY = 86400.0
+
+class ObservationStore:
+    """Columnar store of one patient's lab observations.
+
+    Rows are kept as parallel NumPy arrays (test id, value, unit id, epoch seconds, whether the time was timezone
+    aware) sorted by test and then by time, with `_bounds` giving each test's slice, so the latest value is the last
+    row of the slice and time ranges are binary searches within it. Observations are buffered by `append` and packed into arrays on the first query.
+    """
+
+    def __init__(self):
+        self.tests: List[str] = []
+        self.units: List[str] = []
+        self._test_ids: Dict[str, int] = {}
+        self._unit_ids: Dict[str, int] = {}
+        self._pending: List[Tuple[int, float, int, float, bool]] = []
+        self.test_id = np.empty(0, dtype=np.int16)
+        self.value = np.empty(0, dtype=np.float64)
+        self.unit_id = np.empty(0, dtype=np.int16)
+        self.timestamp = np.empty(0, dtype=np.float64)
+        self.aware = np.empty(0, dtype=bool)
+        self._bounds = np.zeros(1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.value) + len(self._pending)
+
+    def __getstate__(self):
+        self._pack()
+        return self.__dict__
+
+    def append(self, test: str, value: float, unit: str, when: datetime) -> None:
+        test_id = self._test_ids.get(test)
+        if test_id is None:
+            test_id = self._test_ids[test] = len(self.tests)
+            self.tests.append(test)
+        unit_id = self._unit_ids.get(unit)
+        if unit_id is None:
+            unit_id = self._unit_ids[unit] = len(self.units)
+            self.units.append(unit)
+        # Naive times are taken as local time by timestamp(), and given back the same way by latest()
+        self._pending.append((test_id, value, unit_id, when.timestamp(), when.tzinfo is not None))
+
+    def _pack(self) -> None:
+        if not self._pending:
+            return
+        test_id, value, unit_id, timestamp, aware = zip(*self._pending)
+        self._pending = []
+        self.test_id = np.concatenate([self.test_id, np.array(test_id, dtype=np.int16)])
+        self.value = np.concatenate([self.value, np.array(value, dtype=np.float64)])
+        self.unit_id = np.concatenate([self.unit_id, np.array(unit_id, dtype=np.int16)])
+        self.timestamp = np.concatenate([self.timestamp, np.array(timestamp, dtype=np.float64)])
+        self.aware = np.concatenate([self.aware, np.array(aware, dtype=bool)])
+        order = np.lexsort((self.timestamp, self.test_id))
+        self.test_id = self.test_id[order]
+        self.value = self.value[order]
+        self.unit_id = self.unit_id[order]
+        self.timestamp = self.timestamp[order]
+        self.aware = self.aware[order]
+        self._bounds = np.searchsorted(self.test_id, np.arange(len(self.tests) + 1))
+
+    def _slice(self, test: str) -> Tuple[int, int]:
+        self._pack()
+        test_id = self._test_ids.get(test)
+        if test_id is None:
+            return 0, 0
+        return int(self._bounds[test_id]), int(self._bounds[test_id + 1])
+
+    def latest(self, test: str) -> Optional[Tuple[float, str, datetime]]:
+        start, end = self._slice(test)
+        if start == end:
+            return None
+        row = end - 1
+        when = datetime.fromtimestamp(float(self.timestamp[row]), timezone.utc if self.aware[row] else None)
+        return float(self.value[row]), self.units[self.unit_id[row]], when
+
+    def between(self, test: str, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Timestamps and values of a test observed in [start, end], oldest first
+        first, last = self._slice(test)
+        timestamp = self.timestamp[first:last]
+        low = 0 if start is None else int(np.searchsorted(timestamp, start.timestamp(), side='left'))
+        high = len(timestamp) if end is None else int(np.searchsorted(timestamp, end.timestamp(), side='right'))
+        return timestamp[low:high], self.value[first + low:first + high]
+
+    def trend(self, test: str, days: float, now: Optional[datetime] = None) -> Optional[Dict[str, float]]:
+        # Summary of a test over the `days` days up to `now`; slope is in value units per day
+        until = time.time() if now is None else now.timestamp()
+        first, last = self._slice(test)
+        timestamp = self.timestamp[first:last]
+        low = int(np.searchsorted(timestamp, until - days * SECONDS_PER_DAY, side='left'))
+        high = int(np.searchsorted(timestamp, until, side='right'))
+        if low == high:
+            return None
+        elapsed = (timestamp[low:high] - timestamp[low]) / SECONDS_PER_DAY
+        value = self.value[first + low:first + high]
+        slope = 0.0
+        spread = elapsed - elapsed.mean()
+        denominator = float(np.dot(spread, spread))
+        if denominator > 0:
+            slope = float(np.dot(spread, value - value.mean()) / denominator)
+        return {'count': high - low, 'min': float(value.min()), 'max': float(value.max()),
+                'mean': float(value.mean()), 'slope': slope}
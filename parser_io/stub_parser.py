@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Stand-in criteria parser speaking the parserpool worker protocol.
+
+Recognises "<variable alias> <comparator> <number>" in the eligibility text for the numerical variables in
+variables.csv and answers with rows shaped like the cfg parser's output. `--exit-after N` makes the process exit
+after N requests, to exercise worker restarts.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+
+HEADER = "#nct_id\teligibility_type\tvariable_type\tcriterion\tquestion\trelation"
+NUMBER = r"(\d+(?:\.\d+)?)"
+COMPARATORS = {'>': ('lower', False), '>=': ('lower', True), '≥': ('lower', True),
+               '<': ('upper', False), '<=': ('upper', True), '≤': ('upper', True)}
+
+def load_variables(path):
+    patterns = []
+    with open(path) as variables_csv:
+        for row in csv.DictReader(variables_csv):
+            if row['variable_type'] != 'numerical':
+                continue
+            aliases = "|".join(re.escape(alias) for alias in row['aliases'].split("|") if alias)
+            pattern = re.compile(rf"\b(?:{aliases})\b[^<>≤≥\d]{{0,20}}(>=|<=|>|<|≥|≤)\s*{NUMBER}", re.IGNORECASE)
+            patterns.append((row['variable_name'], row['question'], pattern))
+    return patterns
+
+def parse(request, patterns):
+    rows = []
+    criteria = request.get('eligibility_criteria') or ''
+    split = re.search(r"exclusion criteria", criteria, re.IGNORECASE)
+    for name, question, pattern in patterns:
+        for match in pattern.finditer(criteria):
+            bound, inclusive = COMPARATORS[match.group(1)]
+            eligibility_type = 'exclusion' if split and match.start() > split.start() else 'inclusion'
+            relation = {'name': name, bound: {'incl': inclusive, 'value': match.group(2)}}
+            criterion = " ".join(match.group(0).split())
+            rows.append("\t".join([request['nct_id'], eligibility_type, 'numerical', criterion, question, json.dumps(relation)]))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--variables", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "variables.csv"))
+    parser.add_argument("--exit-after", type=int, default=0)
+    args = parser.parse_args()
+    patterns = load_variables(args.variables)
+    handled = 0
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request.get('ping'):
+            response = {'id': request['id'], 'pong': True}
+        else:
+            response = {'id': request['id'], 'header': HEADER, 'rows': parse(request, patterns)}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+        handled += 1
+        if args.exit_after and handled >= args.exit_after:
+            return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from gevent import Timeout, spawn, joinall
+from gevent.queue import Queue
+import subprocess
+import shlex
+import json
+import time
+import os
+import logging
+
+ParsedTrial = Tuple[str, List[str]]
+
+class WorkerError(Exception):
+    pass
+
+class ParserWorker:
+    """One long-lived criteria parser process speaking line-delimited JSON over stdin/stdout.
+
+    Each request is a single JSON object line, e.g. {"id": 1, "nct_id": ..., "title": ..., "eligibility_criteria": ...}
+    or {"id": 2, "ping": true}; the worker answers with one line carrying the same id, {"id": 1, "header": ..., "rows": [...]}
+    for a trial (header and rows being the parser's TSV output lines) and {"id": 2, "pong": true} for a ping.
+    Timeouts rely on the cooperative pipes of gevent's monkey-patched subprocess module.
+    """
+
+    def __init__(self, command: List[str], timeout: float):
+        self.command = command
+        self.timeout = timeout
+        self.process: Optional[subprocess.Popen] = None
+        self.last_used = 0.0
+        self.restarts = -1
+        self._next_id = 0
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        self.stop()
+        self.restarts += 1
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+        self.last_used = time.monotonic()
+
+    def stop(self) -> None:
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if not self.alive():
+            self.start()
+        self._next_id += 1
+        request = {**request, 'id': self._next_id}
+        process = self.process
+        assert process is not None and process.stdin is not None and process.stdout is not None
+        try:
+            with Timeout(self.timeout, WorkerError(f"Parser worker timed out after {self.timeout}s")):
+                process.stdin.write(json.dumps(request) + "\n")
+                process.stdin.flush()
+                line = process.stdout.readline()
+            if not line:
+                raise WorkerError("Parser worker closed its output")
+            response = json.loads(line)
+            if response.get('id') != request['id']:
+                raise WorkerError(f"Parser worker answered request {response.get('id')} instead of {request['id']}")
+        except (WorkerError, OSError, ValueError):
+            # The worker's stream state is unknown; replace it on next use
+            self.stop()
+            raise
+        self.last_used = time.monotonic()
+        return response
+
+    def healthy(self) -> bool:
+        try:
+            return self.call({'ping': True}).get('pong', False)
+        except (WorkerError, OSError, ValueError) as e:
+            logging.warning(f"Parser worker failed health check: {e}")
+            return False
+
+class ParserPool:
+    """Fixed set of parser workers shared by every filter pass; trials are handed to whichever worker is idle."""
+
+    attempts = 3
+
+    def __init__(self, command: List[str], size: int, timeout: float = 60.0, idle_check: float = 30.0):
+        self.command = command
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self.workers = [ParserWorker(command, timeout) for _ in range(size)]
+        self._idle: Queue = Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def _prepare(self, worker: ParserWorker) -> None:
+        # Workers left idle for a while are pinged before use so a wedged process is replaced up front
+        if worker.alive() and time.monotonic() - worker.last_used > self.idle_check and not worker.healthy():
+            worker.stop()
+        if not worker.alive():
+            worker.start()
+
+    def parse(self, trial_id: str, title: str, criteria: str) -> ParsedTrial:
+        request = {'nct_id': trial_id, 'title': title, 'eligibility_criteria': criteria}
+        failures = 0
+        while True:
+            worker = self._idle.get()
+            try:
+                # Inside the try so a worker that fails to start still goes back to the idle queue
+                self._prepare(worker)
+                response = worker.call(request)
+                return response['header'], response.get('rows', [])
+            except (WorkerError, OSError, ValueError) as e:
+                failures += 1
+                logging.warning(f"Parser worker failed on trial {trial_id} (attempt {failures}): {e}")
+                if failures >= self.attempts:
+                    raise
+            finally:
+                self._idle.put(worker)
+
+    def parse_many(self, trials: Iterable[Tuple[str, str, str]]) -> Dict[str, ParsedTrial]:
+        results: Dict[str, ParsedTrial] = {}
+        jobs: Queue = Queue()
+        for trial in trials:
+            jobs.put(trial)
+        if jobs.empty():
+            return results
+
+        def drain():
+            while not jobs.empty():
+                trial_id, title, criteria = jobs.get()
+                try:
+                    results[trial_id] = self.parse(trial_id, title, criteria)
+                except (WorkerError, OSError, ValueError) as e:
+                    logging.error(f"Could not parse trial {trial_id}: {e}")
+
+        joinall([spawn(drain) for _ in range(min(len(self.workers), jobs.qsize()))])
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        return {'workers': len(self.workers), 'alive': sum(worker.alive() for worker in self.workers),
+                'idle': self._idle.qsize(), 'restarts': sum(max(0, worker.restarts) for worker in self.workers)}
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.stop()
+
+_pools: Dict[str, ParserPool] = {}
+
+def pool_from_config(config: Dict[str, Any]) -> Optional[ParserPool]:
+    command = config.get('CRITERIA_PARSER_WORKER')
+    if not command:
+        return None
+    pool = _pools.get(command)
+    if pool is None:
+        size = config.get('CRITERIA_PARSER_WORKERS') or os.cpu_count() or 1
+        pool = _pools.setdefault(command, ParserPool(shlex.split(command), size, config.get('CRITERIA_PARSER_TIMEOUT', 60.0)))
+    return pool
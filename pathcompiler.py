@@ -0,0 +1,221 @@
+from typing import Any, Callable, Dict, List
+from jmespath.visitor import TreeInterpreter
+import jmespath
+import timeit
+
+Accessor = Callable[[Any], Any]
+
+_interpreter = TreeInterpreter()
+
+def _is_false(value: Any) -> bool:
+    return value == '' or value == [] or value == {} or value is None or value is False
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _equals(x: Any, y: Any) -> bool:
+    # Same as the interpreter: 0 and 1 never equal False and True
+    if _is_number(x) and x in (0, 1):
+        if isinstance(y, bool):
+            return False
+    elif _is_number(y) and y in (0, 1):
+        if isinstance(x, bool):
+            return False
+    return x == y
+
+def _field(name: str) -> Accessor:
+    def field(value):
+        return value.get(name) if isinstance(value, dict) else None
+    return field
+
+def _index(position: int) -> Accessor:
+    def index(value):
+        if not isinstance(value, list):
+            return None
+        try:
+            return value[position]
+        except IndexError:
+            return None
+    return index
+
+def _chain(first: Accessor, second: Accessor) -> Accessor:
+    def chain(value):
+        return second(first(value))
+    return chain
+
+def _identity(value: Any) -> Any:
+    return value
+
+def _literal(constant: Any) -> Accessor:
+    def literal(value):
+        return constant
+    return literal
+
+def _projection(base: Accessor, each: Accessor) -> Accessor:
+    def projection(value):
+        items = base(value)
+        if not isinstance(items, list):
+            return None
+        collected = []
+        for item in items:
+            result = each(item)
+            if result is not None:
+                collected.append(result)
+        return collected
+    return projection
+
+def _filter_projection(base: Accessor, each: Accessor, condition: Accessor) -> Accessor:
+    def filter_projection(value):
+        items = base(value)
+        if not isinstance(items, list):
+            return None
+        collected = []
+        for item in items:
+            if not _is_false(condition(item)):
+                result = each(item)
+                if result is not None:
+                    collected.append(result)
+        return collected
+    return filter_projection
+
+def _flatten(base: Accessor) -> Accessor:
+    def flatten(value):
+        items = base(value)
+        if not isinstance(items, list):
+            return None
+        merged: List[Any] = []
+        for item in items:
+            if isinstance(item, list):
+                merged.extend(item)
+            else:
+                merged.append(item)
+        return merged
+    return flatten
+
+def _equality(left: Accessor, right: Accessor, negate: bool) -> Accessor:
+    if negate:
+        def not_equal(value):
+            return not _equals(left(value), right(value))
+        return not_equal
+    def equal(value):
+        return _equals(left(value), right(value))
+    return equal
+
+def _and(left: Accessor, right: Accessor) -> Accessor:
+    def and_expression(value):
+        result = left(value)
+        return result if _is_false(result) else right(value)
+    return and_expression
+
+def _or(left: Accessor, right: Accessor) -> Accessor:
+    def or_expression(value):
+        result = left(value)
+        return right(value) if _is_false(result) else result
+    return or_expression
+
+def _multi_select_list(children: List[Accessor]) -> Accessor:
+    def multi_select_list(value):
+        if value is None:
+            return None
+        return [child(value) for child in children]
+    return multi_select_list
+
+def _multi_select_dict(children: List[Any]) -> Accessor:
+    def multi_select_dict(value):
+        if value is None:
+            return None
+        return {key: child(value) for key, child in children}
+    return multi_select_dict
+
+def _function(name: str, arguments: List[Accessor]) -> Accessor:
+    functions = _interpreter._functions
+    def function(value):
+        return functions.call_function(name, [argument(value) for argument in arguments])
+    return function
+
+def _interpreted(node: Dict[str, Any]) -> Accessor:
+    def interpreted(value):
+        return _interpreter.visit(node, value)
+    return interpreted
+
+def compile_node(node: Dict[str, Any]) -> Accessor:
+    """Turns a jmespath AST node into a closure with the interpreter's semantics.
+
+    Node types without a specialised closure are evaluated by the jmespath interpreter, so every expression compiles.
+    """
+    kind = node['type']
+    children = node['children']
+    if kind == 'field':
+        return _field(node['value'])
+    if kind == 'index':
+        return _index(node['value'])
+    if kind in ('subexpression', 'index_expression', 'pipe'):
+        accessor = compile_node(children[0])
+        for child in children[1:]:
+            accessor = _chain(accessor, compile_node(child))
+        return accessor
+    if kind in ('identity', 'current'):
+        return _identity
+    if kind == 'literal':
+        return _literal(node['value'])
+    if kind == 'projection':
+        return _projection(compile_node(children[0]), compile_node(children[1]))
+    if kind == 'filter_projection':
+        return _filter_projection(compile_node(children[0]), compile_node(children[1]), compile_node(children[2]))
+    if kind == 'flatten':
+        return _flatten(compile_node(children[0]))
+    if kind == 'comparator' and node['value'] in ('eq', 'ne'):
+        return _equality(compile_node(children[0]), compile_node(children[1]), node['value'] == 'ne')
+    if kind == 'and_expression':
+        return _and(compile_node(children[0]), compile_node(children[1]))
+    if kind == 'or_expression':
+        return _or(compile_node(children[0]), compile_node(children[1]))
+    if kind == 'multi_select_list':
+        return _multi_select_list([compile_node(child) for child in children])
+    if kind == 'multi_select_dict':
+        return _multi_select_dict([(child['value'], compile_node(child['children'][0])) for child in children])
+    if kind == 'function_expression':
+        return _function(node['value'], [compile_node(child) for child in children])
+    return _interpreted(node)
+
+class CompiledPath:
+    """Drop-in replacement for `jmespath.parser.ParsedResult` evaluating a pre-built closure tree."""
+
+    __slots__ = ('expression', 'parsed', 'search')
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.parsed = jmespath.compile(expression).parsed
+        self.search: Accessor = compile_node(self.parsed)
+
+    def __repr__(self) -> str:
+        return f"CompiledPath({self.expression!r})"
+
+def compile(expression: str) -> CompiledPath:
+    return CompiledPath(expression)
+
+def _benchmark(number: int = 20000) -> None:
+    import fhir
+    samples = {
+        fhir.Observation: {'resourceType': 'Observation', 'effectiveDateTime': '2019-01-02T03:04:05Z',
+                           'code': {'coding': [{'system': 'http://snomed.info/sct', 'code': '1'}, {'system': 'http://loinc.org', 'code': '718-7'}]},
+                           'valueQuantity': {'value': 13.5, 'code': 'g/dL'}},
+        fhir.Demographics: {'name': [{'given': ['Jane'], 'family': 'Doe'}], 'gender': 'female', 'birthDate': '1950-01-01',
+                            'address': [{'postalCode': '20001'}]},
+        fhir.Condition: {'code': {'text': 'Breast cancer', 'coding': [{'code': '254837009', 'system': 'http://snomed.info/sct'}]},
+                         'category': {'coding': [{'code': 'diagnosis'}]}},
+        fhir.ExplanationOfBenefit: {'diagnosis': [{'diagnosisCodeableConcept': {'coding': [{'code': code, 'system': 'http://hl7.org/fhir/sid/icd-9-cm', 'display': 'x'}]}}
+                                                  for code in ('1740', '9999999', '2720')]}
+    }
+    for cls, resource in samples.items():
+        for key, expression in cls.expressions.items():
+            interpreted = jmespath.compile(expression)
+            compiled = compile(expression)
+            assert compiled.search(resource) == interpreted.search(resource), expression
+            slow = timeit.timeit(lambda: interpreted.search(resource), number=number)
+            fast = timeit.timeit(lambda: compiled.search(resource), number=number)
+            label = f"{cls.__name__}.{key}"
+            print(f"{label:<32} interpreted {slow * 1e6 / number:7.2f}us  compiled {fast * 1e6 / number:7.2f}us  x{slow / fast:.1f}")
+
+if __name__ == "__main__":
+    _benchmark()
@@ -1,11 +1,14 @@
 import json
-import requests as req
+import httpclient
 import logging
 import re
+import operator
 import boto3, botocore
 import subprocess
 from typing import Dict, List, Any, Tuple, Optional, Union
 from flask import current_app as app
+from cache import LruCache
+from criteriastore import criteria_key
 import time
 
 client = boto3.client(service_name="comprehendmedical", config=botocore.client.Config(max_pool_connections=40),region_name='us-east-2')
@@ -21,6 +24,11 @@ LOINC_CODES = {
 match_type = 'hemoglobin|platelets|leukocytes'
 lab_pattern = re.compile(f'(\[?({match_type})\]?\s?[\>\=\<]+\s?\d+[\.\,]?\d*\s?\w+\/?\s?\w+(\^\d*)?)')
 lab_simple = re.compile(f'({match_type})')
+comparison_pattern = re.compile('(\s?[\>\=\<]+\s?\d+[\,\.]?\d*)')
+condition_pattern = re.compile('(?P<operator>[\>\=\<]+)\s?(?P<threshold>\d+[\,\.]?\d*)(?P<unit>.*)')
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '=<': operator.le, '>': operator.gt, '>=': operator.ge, '=>': operator.ge,
+             '=': operator.eq, '==': operator.eq}
 
 def rchop(thestring, ending):
   if thestring.endswith(ending):
@@ -29,7 +37,7 @@ def rchop(thestring, ending):
 
 def get_api(token, url, params=None):
     headers = {"Authorization": "Bearer {}".format(token)}
-    res = req.get(url, headers=headers, params=params)
+    res = httpclient.get(url, headers=headers, params=params)
     return res.json()
 
 def find_trials(ncit_codes, gender="unknown", age=0):
@@ -49,7 +57,7 @@ def find_trials(ncit_codes, gender="unknown", age=0):
                 params["eligibility.structured.max_age_in_years_gte"] = age
                 params["eligibility.structured.min_age_in_years_lte"] = age
             now = time.clock()
-            res = req.get(app.config['TRIALS_URL'], params=params)
+            res = httpclient.get(app.config['TRIALS_URL'], params=params)
             logging.debug(f"Time elapsed: {time.clock()-now} seconds")
             res_dict = res.json()
             trialset = {"code_ncit": ncit, "trialset": res_dict}
@@ -59,7 +67,7 @@ def find_trials(ncit_codes, gender="unknown", age=0):
             trials.append(trialset)
             if (gender != "unknown"):
                 params["eligibility.structured.gender"] = gender
-                res = req.get(app.config['TRIALS_URL'], params=params)
+                res = httpclient.get(app.config['TRIALS_URL'], params=params)
                 res_dict = res.json()
                 trialset = {"code_ncit": ncit, "trialset": res_dict}
                 total = res_dict["total"]
@@ -69,22 +77,17 @@ def find_trials(ncit_codes, gender="unknown", age=0):
     return trials
 
 def find_new_trails(ncit_code, url):
-    tries_left = 5
+    # Transient failures are retried with backoff by httpclient, and fail fast while clinicaltrials.gov's circuit is open
     search_text = f"{ncit_code['ncit_desc']} AND SEARCH[Location](AREA[LocationCountry]United States AND AREA[LocationStatus]Recruiting)"
-    while tries_left>0:
-        logging.info('Calling clinicaltrials.gov api for ncit_code-' + ncit_code['ncit'] + ' and ncit desc -' + ncit_code['ncit_desc'] )
-        params: Dict[str, Union[str,int]] = {'expr': search_text, 'min_rnk': 1, 'max_rnk': 100, 'fmt': 'json'} #get trials based on condition
-        response = req.get(url, params=params)
-        filter: list = []
-        #filter based on age/gender/demographic`s/make sure the trial is still valid
-        if response.status_code == 200:
-            return response.json()
-
-        logging.warn(f"Response code = {response.status_code}")
-        logging.warn(f"Response text = {response.text}")
-        tries_left -= 1
-        logging.warn(f"Tries left = {tries_left}")
-        time.sleep(5)
+    logging.info('Calling clinicaltrials.gov api for ncit_code-' + ncit_code['ncit'] + ' and ncit desc -' + ncit_code['ncit_desc'] )
+    params: Dict[str, Union[str,int]] = {'expr': search_text, 'min_rnk': 1, 'max_rnk': 100, 'fmt': 'json'} #get trials based on condition
+    response = httpclient.get(url, params=params)
+    #filter based on age/gender/demographic`s/make sure the trial is still valid
+    if response.status_code == 200:
+        return response.json()
+
+    logging.warn(f"Response code = {response.status_code}")
+    logging.warn(f"Response text = {response.text}")
     return {}
 
 # def find_all_codes(disease_list):
@@ -130,38 +133,85 @@ def get_lab_observations_by_patient(patient_id, token):
     values_by_cell_type = {LOINC_CODES[key]: val['value'] for key, val in lab_results.items()}
     return values_by_cell_type
 
+class LabCondition:
+    """A lab threshold found in a trial's inclusion criteria, e.g. "platelets >= 100,000/ul", parsed once."""
+
+    __slots__ = ('text', 'operator', 'threshold', 'unit')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.operator = None
+        self.threshold: Optional[float] = None
+        self.unit: Optional[str] = None
+        match = condition_pattern.search(text)
+        if match is not None:
+            self.operator = OPERATORS.get(match.group('operator'))
+            self.threshold = float(match.group('threshold').replace(',', ''))
+            self.unit = match.group('unit').strip() or None
+
+    def test(self, lab_value: Any) -> bool:
+        # Lab values are strings, (value, unit) pairs or TestResults; unreadable values and conditions never pass
+        lab_value = getattr(lab_value, 'value', lab_value)
+        if isinstance(lab_value, tuple):
+            lab_value = lab_value[0]
+        if self.operator is None or self.threshold is None or lab_value == "0":
+            return False
+        try:
+            value = float(str(lab_value).replace(',', ''))
+        except ValueError:
+            return False
+        return self.operator(value, self.threshold)
+
+# A trial's parsed lab conditions, keyed by trial id and a hash of its inclusion criteria so a trial whose
+# description changes is parsed again
+conditions_cache: LruCache[Dict[str, LabCondition]] = LruCache()
+
+def conditions_key(trial: Any) -> str:
+    return criteria_key(trial.id, "\n".join(trial.inclusions or []))
+
+def compile_conditions(trial: Any) -> Dict[str, LabCondition]:
+    key = conditions_key(trial)
+    conditions = conditions_cache.get(key)
+    if conditions is None:
+        conditions = {cell_type: LabCondition(condition) for cell_type, condition in find_conditions(trial).items()}
+        conditions_cache.put(key, conditions)
+    return conditions
+
+def evaluate_trials(trials: List, lab_results: Dict) -> List[bool]:
+    """Tests every trial's lab conditions against the lab results, setting its filter_condition.
+
+    :return: whether each trial is included
+    """
+    included = []
+    for trial in trials:
+        conditions = compile_conditions(trial)
+        if not conditions:
+            trial.filter_condition = [('No Inclusion Criteria Found', True)]
+            included.append(True)
+            continue
+        trial.filter_condition = []
+        include_trial = True
+        for cell_type, condition in conditions.items():
+            lab_value = lab_results.get(cell_type)
+            passed = not lab_value or condition.test(lab_value)
+            include_trial = include_trial and passed
+            trial.filter_condition.append((condition.text, passed))
+        included.append(include_trial)
+    return included
+
 def filter_trials_from_description(trials: List, lab_results: Dict) -> Tuple[list, list]:
     """
     :param trials: List[obj(Trail)]
-    :param comparision_val: str
-    :param cell_type: str
+    :param lab_results: Dict[cell_type, lab value]
     :return: (List[obj(Trial], List[obj(Trial)])
     """
     filtered_trials = []
     excluded_trials = []
-    for trial in trials:
-        conditions = find_conditions(trial)
-        trial.filter_condition = []
-        if conditions:
-            include_trail = True
-            for cell_type, condition in conditions.items():
-                lab_value = lab_results.get(cell_type)
-                if not lab_value:
-                    trial.filter_condition.append((condition, True))
-                    continue
-                lab_value, converted_condition = convert_expressions(lab_value, condition)
-                if (lab_value != "0") and eval(lab_value + converted_condition):
-                    trial.filter_condition.append((condition, True))
-                else:
-                    include_trail = False
-                    trial.filter_condition.append((condition, False))
-            if include_trail:
-                filtered_trials.append(trial)
-            else:
-                excluded_trials.append(trial)
-        else:
-            trial.filter_condition.append(('No Inclusion Criteria Found', True))
+    for trial, included in zip(trials, evaluate_trials(trials, lab_results)):
+        if included:
             filtered_trials.append(trial)
+        else:
+            excluded_trials.append(trial)
     return filtered_trials, excluded_trials
 
 
@@ -252,10 +302,9 @@ def convert_expressions(lab_value: str, condition: str):
     # platelets< 100 x 10^9/l, >= 100000/ul
     # leukocytes: 3000/ mm^3, >= 3000/mcl
 
-    pattern = re.compile('(\s?[\>\=\<]+\s?\d+[\,\.]?\d*)')
     # if type(condition) is List:
     #     condition = condition[0]
-    condition_reg = pattern.findall(condition)
+    condition_reg = comparison_pattern.findall(condition)
     if len(condition_reg) == 0:
         return "0", ""
     condition = condition_reg[0].replace(',', '')
@@ -0,0 +1,107 @@
+from typing import Optional, Set
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+import time
+import logging
+
+RETRY_STATUSES: Set[int] = {429, 500, 502, 503, 504}
+
+class RetryPolicy:
+    """Jittered exponential backoff that defers to a server's Retry-After when one is given.
+
+    "full" jitter draws the delay from [0, backoff]; "equal" jitter from [backoff / 2, backoff], for pollers that
+    must not spin when the draw lands near zero.
+    """
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 10.0, jitter: str = 'full'):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    @staticmethod
+    def retry_after(header: Optional[str]) -> Optional[float]:
+        if not header:
+            return None
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(header)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        requested = self.retry_after(retry_after)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        backoff = min(self.max_delay, self.base_delay * (2 ** attempt))
+        if self.jitter == 'equal':
+            return backoff / 2 + random.uniform(0, backoff / 2)
+        return random.uniform(0, backoff)
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures, then lets a single probe through every `reset_timeout` seconds."""
+
+    def __init__(self, host: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def cancel_probe(self) -> None:
+        # The probe ended without an outcome (e.g. its greenlet was killed); the next caller may probe again
+        self.probing = False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logging.info(f"Circuit for {self.host} closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logging.warning(f"Circuit for {self.host} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+class RetryBudget:
+    """Token bucket limiting retries to a fraction of recent requests, so retries cannot multiply load during an outage."""
+
+    def __init__(self, ratio: float = 0.2, max_tokens: float = 20.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
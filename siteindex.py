@@ -0,0 +1,137 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from distances import haversine
+from zipcode import Zipcode
+
+EARTH_RADIUS = 3958.8
+
+class SiteIndex:
+    """Trial sites bucketed into a latitude/longitude grid for radius and nearest-site queries.
+
+    Sites are sorted by grid cell, so each cell is a contiguous slice of the arrays. A radius query visits only the
+    cells the spherical cap around the origin can touch and measures exact distances to the sites in them.
+    Sites with no known coordinates are not indexed.
+    """
+
+    def __init__(self, trial_ids: List[str], site_trial: np.ndarray, lat: np.ndarray, long: np.ndarray,
+                 sites: List[Dict[str, Any]], cell_degrees: float = 1.0):
+        self.trial_ids = trial_ids
+        self.cell_degrees = cell_degrees
+        self.bands = int(np.ceil(180 / cell_degrees))
+        self.buckets = int(np.ceil(360 / cell_degrees))
+        known = ~(np.isnan(lat) | np.isnan(long))
+        cells = self._cells(lat[known], long[known])
+        order = np.argsort(cells, kind='stable')
+        self.cells = cells[order]
+        self.lat = lat[known][order]
+        self.long = long[known][order]
+        self.site_trial = site_trial[known][order]
+        known_sites = [site for site, is_known in zip(sites, known) if is_known]
+        self.sites = [known_sites[row] for row in order]
+
+    @classmethod
+    def from_trials(cls, trials: Iterable, zipcodes: Zipcode, **kwargs) -> 'SiteIndex':
+        # NCI sites with coordinates are placed as given; the rest, and every clinicaltrials.gov location, are
+        # geocoded from their ZIP code in one lookup
+        trial_ids: List[str] = []
+        sites: List[Dict[str, Any]] = []
+        site_trial: List[int] = []
+        lat: List[float] = []
+        long: List[float] = []
+        zip_sites: List[Dict[str, Any]] = []
+        zip_trial: List[int] = []
+        zips: List[str] = []
+        for index, trial in enumerate(trials):
+            trial_ids.append(trial.id)
+            for site in trial.sites or []:
+                coordinates = site.get("org_coordinates")
+                if coordinates:
+                    sites.append(site)
+                    site_trial.append(index)
+                    lat.append(coordinates["lat"])
+                    long.append(coordinates["lon"])
+                else:
+                    zip_sites.append(site)
+                    zip_trial.append(index)
+                    zips.append((site.get('org_postal_code') or '')[:5])
+            for site in trial.locations or []:
+                zip_sites.append(site)
+                zip_trial.append(index)
+                zips.append((site.get("LocationZip") or '')[:5])
+        zip_lat, zip_long, _ = zipcodes.zip2geo_many(zips)
+        return cls(trial_ids, np.array(site_trial + zip_trial, dtype=np.int64),
+                   np.concatenate([np.array(lat, dtype=np.float64), zip_lat]),
+                   np.concatenate([np.array(long, dtype=np.float64), zip_long]), sites + zip_sites, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.sites)
+
+    def _band(self, lat):
+        return np.clip(np.floor((np.asarray(lat) + 90) / self.cell_degrees).astype(np.int64), 0, self.bands - 1)
+
+    def _cells(self, lat: np.ndarray, long: np.ndarray) -> np.ndarray:
+        buckets = np.floor((long + 180) / self.cell_degrees).astype(np.int64) % self.buckets
+        return self._band(lat) * self.buckets + buckets
+
+    def distances_from(self, origin: Tuple[float, float]) -> np.ndarray:
+        # Miles from the origin to every indexed site, in the order of `sites`
+        return haversine(origin[0], origin[1], self.lat, self.long, EARTH_RADIUS)
+
+    def _candidates(self, origin: Tuple[float, float], miles: float) -> np.ndarray:
+        # Rows of every site in a cell the cap of `miles` around the origin touches
+        angle = miles / EARTH_RADIUS
+        if angle >= np.pi:
+            return np.arange(len(self.sites))
+        lat, long = origin
+        reach = np.degrees(angle) + 1e-6
+        bands = np.arange(self._band(max(lat - reach, -90.0)), self._band(min(lat + reach, 90.0)) + 1)
+        if abs(lat) + reach >= 90:
+            ranges = [(0, self.buckets - 1)]
+        else:
+            spread = np.degrees(np.arcsin(min(1.0, np.sin(angle) / np.cos(np.radians(lat))))) + 1e-6
+            first = int(np.floor((long - spread + 180) / self.cell_degrees))
+            last = int(np.floor((long + spread + 180) / self.cell_degrees))
+            if last - first + 1 >= self.buckets:
+                ranges = [(0, self.buckets - 1)]
+            elif first < 0:
+                ranges = [(first + self.buckets, self.buckets - 1), (0, last)]
+            elif last >= self.buckets:
+                ranges = [(first, self.buckets - 1), (0, last - self.buckets)]
+            else:
+                ranges = [(first, last)]
+        low = np.concatenate([bands * self.buckets + first for first, _ in ranges])
+        high = np.concatenate([bands * self.buckets + last for _, last in ranges])
+        starts = np.asarray(np.searchsorted(self.cells, low, side='left'))
+        ends = np.asarray(np.searchsorted(self.cells, high, side='right'))
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.arange(0)])
+
+    def within(self, origin: Tuple[float, float], miles: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows of the sites within `miles` of the origin (all sites if None) and their distances, nearest first."""
+        if miles is None:
+            rows = np.arange(len(self.sites))
+        else:
+            rows = self._candidates(origin, miles)
+        distances = haversine(origin[0], origin[1], self.lat[rows], self.long[rows], EARTH_RADIUS)
+        if miles is not None:
+            inside = distances <= miles
+            rows, distances = rows[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return rows[order], distances[order]
+
+    def nearest_by_trial(self, origin: Tuple[float, float], miles: Optional[float] = None) -> Dict[str, Tuple[float, Dict[str, Any]]]:
+        """Each trial's nearest site within `miles` and its distance, ordered nearest trial first."""
+        rows, distances = self.within(origin, miles)
+        _, first = np.unique(self.site_trial[rows], return_index=True)
+        first.sort()
+        return {self.trial_ids[self.site_trial[rows[position]]]: (float(distances[position]), self.sites[rows[position]])
+                for position in first}
+
+    def nearest_trials(self, origin: Tuple[float, float], count: int, miles: Optional[float] = None) -> Dict[str, Tuple[float, Dict[str, Any]]]:
+        # The `count` trials with the nearest sites, searching outwards from 25 miles until enough trials are found
+        limit = np.pi * EARTH_RADIUS if miles is None else miles
+        radius = min(25.0, limit)
+        while True:
+            nearest = self.nearest_by_trial(origin, radius)
+            if len(nearest) >= count or radius >= limit:
+                return dict(list(nearest.items())[:count])
+            radius = min(radius * 4, limit)
@@ -0,0 +1,121 @@
+from typing import Any, Dict, Iterable, List, Optional, Set
+from datetime import datetime, timezone
+from flask import Config
+import sqlite3 as sql
+import threading
+import argparse
+import json
+import os
+import logging
+import httpclient
+
+PAGE_SIZE = 50
+
+class TrialStore:
+    """Local indexed mirror of active NCI trials, queried the same way `NciApi.get_trials` queries the API."""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sql.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS trials (nci_id TEXT PRIMARY KEY, status TEXT, gender TEXT, min_age REAL, max_age REAL,
+                                               last_updated TEXT, body TEXT);
+            CREATE TABLE IF NOT EXISTS trial_diseases (ncit_code TEXT, nci_id TEXT, PRIMARY KEY (ncit_code, nci_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS trials_eligibility ON trials (status, gender, min_age, max_age);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def find(self, age: int, gender: str, ncit_codes: Set[str]) -> Iterable[Dict[str, Any]]:
+        codes = list(ncit_codes)
+        if not codes:
+            return
+        marks = ",".join("?" * len(codes))
+        query = f"""SELECT body FROM trials WHERE status='Active' AND gender IN (?, 'BOTH') AND min_age<=? AND max_age>=?
+                    AND nci_id IN (SELECT nci_id FROM trial_diseases WHERE ncit_code IN ({marks}))"""
+        with self._lock:
+            rows = self.conn.execute(query, [gender.upper(), age, age, *codes]).fetchall()
+        for (body,) in rows:
+            yield json.loads(body)
+
+    def upsert(self, trials: List[Dict[str, Any]]) -> None:
+        with self._lock, self.conn:
+            for trial in trials:
+                nci_id = trial['nci_id']
+                structured = trial.get('eligibility', {}).get('structured', {}) or {}
+                min_age = structured.get('min_age_in_years')
+                max_age = structured.get('max_age_in_years')
+                self.conn.execute("INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (nci_id, trial.get('current_trial_status'), (structured.get('gender') or 'BOTH').upper(),
+                                   0 if min_age is None else min_age, 999 if max_age is None else max_age,
+                                   trial.get('date_last_updated_anything'), json.dumps(trial)))
+                self.conn.execute("DELETE FROM trial_diseases WHERE nci_id=?", (nci_id,))
+                codes = {disease.get('nci_thesaurus_concept_id') for disease in trial.get('diseases') or []}
+                self.conn.executemany("INSERT OR IGNORE INTO trial_diseases VALUES (?, ?)",
+                                      [(code, nci_id) for code in codes if code])
+
+    def sync(self, url: str, headers: Optional[Dict[str, str]] = None, full: bool = False) -> int:
+        # `url` is the TRIALS_URL NciApi queries. Pages are requested the way NciApi requests them, from offset 1.
+        # An interrupted sync starts again from the first page, since last_sync is only written at the end: offsets
+        # shift as trials are updated, so resuming at one could skip trials, and upserting a trial twice is harmless.
+        # Incremental syncs re-read the day of the previous one for the same reason.
+        started = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        since = None if full else self.get_meta('last_sync')
+        params: Dict[str, Any] = {'size': str(PAGE_SIZE)}
+        if since:
+            # Incremental: every trial touched since the last sync, whatever its status, so closures are mirrored too
+            params['date_last_updated_anything_gte'] = since
+        else:
+            params['current_trial_status'] = 'Active'
+        logging.info(f"Syncing trials from {url} since {since or 'the beginning'}")
+        synced = 0
+        start_from = 1
+        total = 1
+        while start_from <= total:
+            params['from'] = str(start_from)
+            res = httpclient.get(url, params=params, headers=headers)
+            res.raise_for_status()
+            page = res.json()
+            total = page.get('total', 0)
+            trials = page.get('trials', page.get('data', []))
+            if not trials:
+                break
+            self.upsert(trials)
+            synced += len(trials)
+            start_from += len(trials)
+            logging.info(f"Synced {synced} of {total} trials")
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_sync', ?)", (started,))
+        return synced
+
+_stores: Dict[str, TrialStore] = {}
+
+def open_store(path: str) -> TrialStore:
+    store = _stores.get(path)
+    if store is None:
+        store = _stores.setdefault(path, TrialStore(path))
+    return store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync the local NCI trial mirror")
+    parser.add_argument("--db", default="cache/trials.sqlite", help="Path of the local trial store")
+    parser.add_argument("--env", default="local", choices=["local", "aws", "test_aws"], help="Configuration to read TRIALS_URL from")
+    parser.add_argument("--url", help="NCI clinical trials API url, overriding the configured TRIALS_URL")
+    parser.add_argument("--api-key", help="NCI API key (X-API-KEY header)")
+    parser.add_argument("--full", action="store_true", help="Ignore the last sync timestamp and pull all active trials")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    config = Config(os.path.dirname(os.path.abspath(__file__)))
+    config.from_pyfile(f"config/{args.env}.cfg")
+    config.from_pyfile("config/default.cfg")
+    httpclient.configure(config)
+    synced = TrialStore(args.db).sync(args.url or config['TRIALS_URL'], {'X-API-KEY': args.api_key} if args.api_key else None, args.full)
+    logging.info(f"Sync complete, {synced} trials updated")
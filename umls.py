@@ -1,5 +1,11 @@
 
-import requests
+import httpclient
+import time
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple, cast
+from gevent import spawn, Greenlet
+from gevent.lock import Semaphore
 #from pyquery import PyQuery as pq
 import lxml.html as lh
 from lxml.html import fromstring
@@ -23,8 +29,8 @@ class Authentication:
    def gettgt(self):
         params = {'apikey': self.apikey}
         h = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain", "User-Agent":"python" }
-        r = requests.post(uri+auth_endpoint, data=params, headers=h)
-        app.logger.debug(f"UMLS tgt response: {r.text}, code: {r.status_code}")
+        r = httpclient.post(uri+auth_endpoint, data=params, headers=h)
+        logging.debug(f"UMLS tgt response: {r.text}, code: {r.status_code}")
         response = fromstring(r.text)
         # extract the entire URL needed from the HTML form (action attribute) returned - looks similar to
         # https://utslogin.nlm.nih.gov/cas/v1/tickets/TGT-36471-aYqNLN2rFIJPXKzxwdTNC5ZT7z3B3cTAKfSc5ndHQcUxeaDOLN-cas
@@ -35,6 +41,92 @@ class Authentication:
    def getst(self,tgt):
         params = {'service': self.service}
         h = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain", "User-Agent":"python" }
-        r = requests.post(tgt,data=params,headers=h)
+        r = httpclient.post(tgt,data=params,headers=h)
         st = r.text
         return st
+
+
+class TicketManager:
+    """Process-wide holder of one UMLS ticket-granting ticket plus a small pool of prefetched service tickets.
+
+    A TGT is valid for 8 hours and is refreshed in the background once it is within `refresh_margin` of expiry.
+    Service tickets are single use and expire after 5 minutes, so unused ones are discarded once stale.
+    """
+
+    tgt_lifetime = 8 * 60 * 60
+    refresh_margin = 30 * 60
+    st_lifetime = 5 * 60 - 30
+
+    def __init__(self, apikey: str, prefetch: int = 4):
+        self.auth = Authentication(apikey)
+        self.prefetch = prefetch
+        self._tgt: Optional[str] = None
+        self._tgt_expires = 0.0
+        self._tgt_lock = Semaphore()
+        self._refreshing: Optional[Greenlet] = None
+        self._service_tickets: Deque[Tuple[str, float]] = deque()
+        self._filling = 0
+
+    def _refresh_tgt(self) -> str:
+        tgt = self.auth.gettgt()
+        self._tgt = tgt
+        self._tgt_expires = time.monotonic() + self.tgt_lifetime
+        self._service_tickets.clear()
+        return tgt
+
+    def tgt(self) -> str:
+        now = time.monotonic()
+        if self._tgt is None or now >= self._tgt_expires:
+            with self._tgt_lock:
+                if self._tgt is None or time.monotonic() >= self._tgt_expires:
+                    logging.info("Requesting new UMLS TGT")
+                    self._refresh_tgt()
+        elif now >= self._tgt_expires - self.refresh_margin and self._refreshing is None:
+            self._refreshing = spawn(self._refresh_early)
+        return cast(str, self._tgt)
+
+    def _refresh_early(self) -> None:
+        try:
+            with self._tgt_lock:
+                logging.info("Refreshing UMLS TGT ahead of expiry")
+                self._refresh_tgt()
+        finally:
+            self._refreshing = None
+
+    def _fetch_service_ticket(self) -> None:
+        try:
+            tgt = self.tgt()
+            self._service_tickets.append((self.auth.getst(tgt), time.monotonic() + self.st_lifetime))
+        except Exception as exc:
+            logging.warning(f"Failed to prefetch UMLS service ticket: {exc}")
+        finally:
+            self._filling -= 1
+
+    def _fill(self) -> None:
+        missing = self.prefetch - len(self._service_tickets) - self._filling
+        for _ in range(missing):
+            self._filling += 1
+            spawn(self._fetch_service_ticket)
+
+    def warm(self) -> None:
+        self.tgt()
+        self._fill()
+
+    def service_ticket(self) -> str:
+        now = time.monotonic()
+        while self._service_tickets:
+            ticket, expires = self._service_tickets.popleft()
+            if expires > now:
+                self._fill()
+                return ticket
+        ticket = self.auth.getst(self.tgt())
+        self._fill()
+        return ticket
+
+_managers: Dict[str, TicketManager] = {}
+
+def tickets(apikey: str) -> TicketManager:
+    manager = _managers.get(apikey)
+    if manager is None:
+        manager = _managers.setdefault(apikey, TicketManager(apikey))
+    return manager
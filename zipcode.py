@@ -1,11 +1,91 @@
-import sqlite3 as sql
+from typing import Dict, Iterable, Optional, Tuple
+import numpy as np
+import argparse
+import csv
+import os
+import logging
+
+CSV_PATH = "zipcodes/zip2geo.csv"
+TABLE_PATH = "zipcodes/zip2geo.npy"
+
+# One row per ZIP code, sorted by zip
+TABLE_DTYPE = np.dtype([('zip', np.int32), ('lat', np.float32), ('lon', np.float32)])
 
 class Zipcode:
-    
-    def __init__(self):
-        self.conn = sql.connect("zipcodes/zipcodes.db")
-        self.db = self.conn.cursor()
-
-    def zip2geo(self, code):
-        self.db.execute("SELECT lat,long FROM zips WHERE zip=?", (code,))
-        return self.db.fetchone()
\ No newline at end of file
+    """ZIP code centroids in a sorted array, looked up by binary search.
+
+    The table is saved as a plain .npy file and opened memory-mapped, so every worker process shares the same pages.
+    """
+
+    def __init__(self, table: np.ndarray):
+        self.table = table
+        self.zips = table['zip']
+        self.lat = table['lat']
+        self.lon = table['lon']
+
+    @classmethod
+    def from_csv(cls, path: str = CSV_PATH) -> 'Zipcode':
+        rows = []
+        with open(path, newline='') as zip_csv:
+            for row in csv.DictReader(zip_csv, delimiter=';'):
+                try:
+                    rows.append((int(row['Zip']), float(row['Latitude']), float(row['Longitude'])))
+                except (TypeError, ValueError):
+                    continue
+        table = np.array(rows, dtype=TABLE_DTYPE)
+        table.sort(order='zip')
+        return cls(table)
+
+    @classmethod
+    def load(cls, path: str = TABLE_PATH) -> 'Zipcode':
+        return cls(np.load(path, mmap_mode='r'))
+
+    def save(self, path: str = TABLE_PATH) -> None:
+        np.save(path, np.ascontiguousarray(self.table))
+
+    @staticmethod
+    def _codes(codes: Iterable[Optional[str]]) -> np.ndarray:
+        # Five-digit strings as ints; anything else as -1, which matches no row
+        return np.array([int(code) if code and len(code) == 5 and code.isdigit() else -1 for code in codes], dtype=np.int64)
+
+    def zip2geo_many(self, codes: Iterable[Optional[str]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Latitudes, longitudes and a found mask for the given ZIP codes; missing codes get NaN coordinates."""
+        codes = self._codes(codes)
+        rows = np.asarray(np.searchsorted(self.zips, codes))
+        rows[rows == len(self.zips)] = 0
+        found = (self.zips[rows] == codes) if len(self.zips) else np.zeros(len(codes), dtype=bool)
+        lat = np.where(found, self.lat[rows], np.nan)
+        lon = np.where(found, self.lon[rows], np.nan)
+        return lat, lon, found
+
+    def zip2geo(self, code: Optional[str]) -> Optional[Tuple[float, float]]:
+        lat, lon, found = self.zip2geo_many([code])
+        return (float(lat[0]), float(lon[0])) if found[0] else None
+
+_zipcodes: Dict[str, Zipcode] = {}
+
+def open_zipcodes(path: str = TABLE_PATH, csv_path: str = CSV_PATH) -> Zipcode:
+    # Maps the prebuilt table, building it from the CSV first when it is missing or older than the CSV
+    zipcodes = _zipcodes.get(path)
+    if zipcodes is None:
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(csv_path):
+            zipcodes = Zipcode.load(path)
+        else:
+            zipcodes = Zipcode.from_csv(csv_path)
+            try:
+                zipcodes.save(path)
+                zipcodes = Zipcode.load(path)
+            except OSError as e:
+                logging.warning(f"Could not save ZIP code table to {path}: {e}")
+        zipcodes = _zipcodes.setdefault(path, zipcodes)
+    return zipcodes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the memory-mapped ZIP code table from the CSV")
+    parser.add_argument("--csv", default=CSV_PATH, help="Path of the ;-separated ZIP code CSV")
+    parser.add_argument("--out", default=TABLE_PATH, help="Path of the table to write")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    zipcodes = Zipcode.from_csv(args.csv)
+    zipcodes.save(args.out)
+    logging.info(f"Wrote {len(zipcodes.zips)} ZIP codes to {args.out}")